@@ -2,17 +2,16 @@ import subprocess
 import time
 import datetime
 import os
-import re
+
+from control_client import LoadTestControl
+from plateau_detector import PlateauDetector
+from prom_scraper import PromScraper
 
 
 HOST = "http://127.0.0.1:8000"
 
-# 得到正在进行的请求数量
-METRICS_CMD = (
-    "curl -s 127.0.0.1:8000/metrics | "
-    "grep 'vllm:num_requests_running' | "
-    "tail -n 1"
-)
+# 用一个长连接抓 /metrics（不再每次 fork curl | grep）
+SCRAPER = PromScraper(HOST)
 
 
 # 可调参数
@@ -20,7 +19,12 @@ QPS_START = 10
 QPS_STEP = 5
 QPS_MAX = 200
 
-PLATEAU_SECONDS = 15
+# 平台期判定：滑动窗口长度、每一轮最短 / 最长时间、趋势与波动的容忍度
+PLATEAU_SECONDS = 30
+PLATEAU_MIN_SECONDS = 30
+PLATEAU_MAX_SECONDS = 600
+PLATEAU_SLOPE = 0.05
+PLATEAU_CV = 0.25
 POLL_SECONDS = 1
 
 # 如果你原来“跑得通”的 locust 命令里需要额外参数（最常见就是 --chat）
@@ -28,10 +32,18 @@ POLL_SECONDS = 1
 # 不需要就留空列表：[]
 MAIN_EXTRA_FLAGS = []   # 如果你平时必须用 --chat，就改成 ["--chat"]
 
-PROBE_EXTRA_FLAGS = []  # 同理：探针需要什么额外参数也写这里
+# 探针直接跑在主压测里（load_test.py --probe-qps），平台期后清零统计，跑 PROBE_SECONDS 秒读探针 TTFT
+PROBE_QPS = 1
+PROBE_MAX_TOKENS = 100
+PROBE_SECONDS = 120
 
 OUT_DIR = "auto_results"
 
+# True：整个扫描只启动一次主压测，之后每一轮通过控制端口直接改 QPS / users（不重启 locust）
+LIVE_MODE = False
+# 主压测的控制端口，两种模式都用它读探针 TTFT
+CONTROL_PORT = 8089
+
 
 def now_string():
     return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -41,25 +53,10 @@ def run_id_string():
     return datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
 
 
-def get_num_requests_running():
-    line = subprocess.getoutput(METRICS_CMD).strip()
-    if line == "":
-        return None
-
-    parts = line.split()
-    if len(parts) < 2:
-        return None
-
-    try:
-        return float(parts[-1])
-    except ValueError:
-        return None
-
-
 def start_main_locust(qps, main_log_path):
     users = int(qps * 1.5)
     spawn_rate = int(qps * 1.5)
-    
+
     cmd = [
         "locust",
         "-f", "load_test.py",
@@ -73,6 +70,9 @@ def start_main_locust(qps, main_log_path):
         "--qps", str(qps),
         "-t", "99999s",
         "--max-tokens", "1000",
+        "--probe-qps", str(PROBE_QPS),
+        "--probe-max-tokens", str(PROBE_MAX_TOKENS),
+        "--control-port", str(CONTROL_PORT),
     ] + MAIN_EXTRA_FLAGS
 
     log_file = open(main_log_path, "a", encoding="utf-8")
@@ -87,45 +87,15 @@ def start_main_locust(qps, main_log_path):
     return proc, log_file
 
 
-def run_probe_and_get_ttft(probe_log_path):
-    cmd = [
-        "locust",
-        "-f", "load_test.py",
-        "--headless",
-        "-H", HOST,
-        "--provider", "vllm",
-        "--model", "/data/models/Qwen3-8B",
-        "--tokenizer", "/data/models/Qwen3-8B",
-        "-u", "1",
-        "-r", "1",
-        "--qps", "1",
-        "-t", "120s",
-        "--max-tokens", "100",
-    ] + PROBE_EXTRA_FLAGS
-
-    print("[" + now_string() + "] 开始探针（120s）...")
-
-    result = subprocess.run(
-        cmd,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-        text=True
-    )
-
-    with open(probe_log_path, "a", encoding="utf-8") as f:
-        f.write("[" + now_string() + "] PROBE CMD: " + " ".join(cmd) + "\n")
-        f.write(result.stdout)
-        f.write("\n")
-
-    # 尝试抓 TTFT：先找包含 ttft 的行，再抓里面的数字
-    # 用来直接抓取ttft的代码（可以删除）
-    ttft_value = None
-    for line in result.stdout.splitlines():
-        if "ttft" in line.lower():
-            nums = re.findall(r"[0-9]+(?:\.[0-9]+)?", line)
-            if len(nums) > 0:
-                ttft_value = nums[-1]
+def measure_probe_ttft(control):
+    # 清零统计，让探针 TTFT 只算平台期之后的请求
+    control.set(reset_stats=True)
+    print("[" + now_string() + "] 开始探针统计（" + str(PROBE_SECONDS) + "s）...")
+    time.sleep(PROBE_SECONDS)
 
+    ttft_value = control.stats()["summary"].get("Probe Time To First Token")
+    if ttft_value == "":
+        return None
     return ttft_value
 
 
@@ -147,13 +117,14 @@ def wait_until_plateau(watcher_log_path):
     """
     关键改动：
     1) 先等到 num_requests_running > 0 至少出现一次（证明 locust 真打到了模型）
-    2) 然后再开始“15秒不增长=平台期”的判断
+    2) 然后用 PlateauDetector 判断各项指标在滑动窗口内是否都稳定了（有最短 / 最长时间）
     """
     print("[" + now_string() + "] 等待 num_requests_running 先变成 > 0 (证明主压测真的打到了模型)...")
 
     # 先等它 > 0
     while True:
-        cur = get_num_requests_running()
+        snapshot = SCRAPER.try_scrape()
+        cur = snapshot.running if snapshot is not None else None
         with open(watcher_log_path, "a", encoding="utf-8") as f:
             f.write("[" + now_string() + "] running=" + str(cur) + "\n")
 
@@ -164,30 +135,41 @@ def wait_until_plateau(watcher_log_path):
 
         time.sleep(POLL_SECONDS)
 
-    # 出现 >0 后，再做平台期计时
-    last_value = cur
-    last_increase_time = time.time()
+    # 出现 >0 后，再看滑动窗口内 running / waiting / KV 使用率 / 完成速率 是否都稳定
+    detector = PlateauDetector(
+        window_seconds=PLATEAU_SECONDS,
+        min_seconds=PLATEAU_MIN_SECONDS,
+        max_seconds=PLATEAU_MAX_SECONDS,
+        slope_tolerance=PLATEAU_SLOPE,
+        cv_tolerance=PLATEAU_CV,
+    )
+    # 证明 running > 0 的那次采样也算进窗口，之后 scrape 一直失败时也会按最长时间超时
+    detector.observe_snapshot(snapshot)
 
-    print("[" + now_string() + "] 已确认主压测在打请求，开始平台期检测（30秒不增长）...")
+    print("[" + now_string() + "] 已确认主压测在打请求，开始平台期检测（窗口 " + str(PLATEAU_SECONDS) + " 秒）...")
 
     while True:
-        cur = get_num_requests_running()
-        now = time.time()
+        time.sleep(POLL_SECONDS)
+
+        snapshot = SCRAPER.try_scrape()
+        detector.observe_snapshot(snapshot)
+        done, reason = detector.check()
+        cur = snapshot.running if snapshot is not None else None
 
         with open(watcher_log_path, "a", encoding="utf-8") as f:
             f.write("[" + now_string() + "] running=" + str(cur) + "\n")
 
         print("[" + now_string() + "] 当前 num_requests_running =", cur)
 
-        if cur is not None and cur > last_value:
-            last_value = cur
-            last_increase_time = now
-
-        if now - last_increase_time >= PLATEAU_SECONDS:
-            print("[" + now_string() + "] 连续 30 秒不增长，平台期到了。")
-            return last_value
-
-        time.sleep(POLL_SECONDS)
+        if done:
+            print("[" + now_string() + "] 平台期判定：" + reason)
+            with open(watcher_log_path, "a", encoding="utf-8") as f:
+                f.write("[" + now_string() + "] " + reason + "\n")
+            # 窗口内的均值，单个尖峰不影响结果
+            final_running = detector.mean("running")
+            if final_running is not None:
+                final_running = round(final_running, 1)
+            return final_running
 
 
 def main():
@@ -202,6 +184,8 @@ def main():
         f.write("time,main_qps,plateau_running,probe_ttft,main_log,probe_log\n")
 
     qps = QPS_START
+    main_proc = None
+    control = None
 
     while qps <= QPS_MAX:
         print("\n==============================")
@@ -209,17 +193,26 @@ def main():
         print("==============================\n")
 
         main_log = os.path.join(out_path, "main_qps_" + str(qps) + ".log")
-        probe_log = os.path.join(out_path, "probe_at_qps_" + str(qps) + ".log")
 
-        main_proc, main_log_file = start_main_locust(qps, main_log)
+        if not LIVE_MODE or main_proc is None:
+            if LIVE_MODE:
+                main_log = os.path.join(out_path, "main_live.log")
+            main_proc, main_log_file = start_main_locust(qps, main_log)
+            control = LoadTestControl(CONTROL_PORT)
+            control.wait_ready()
+        else:
+            print("[" + now_string() + "] 在线调整主压测 QPS =", qps)
+            control.set(qps=qps, users=int(qps * 1.5), spawn_rate=int(qps * 1.5))
 
         plateau_value = wait_until_plateau(watcher_log)
 
-        ttft = run_probe_and_get_ttft(probe_log)
+        ttft = measure_probe_ttft(control)
         print("[" + now_string() + "] 探针结束，TTFT =", ttft)
 
-        # 你要求：探针出结果后，立刻停主压测
-        stop_main(main_proc, main_log_file)
+        # 你要求：探针出结果后，立刻停主压测（live 模式下主压测继续跑，下一轮直接调 QPS）
+        if not LIVE_MODE:
+            control.stop()
+            stop_main(main_proc, main_log_file)
 
         with open(results_csv, "a", encoding="utf-8") as f:
             f.write(now_string() + ",")
@@ -227,11 +220,16 @@ def main():
             f.write(str(plateau_value) + ",")
             f.write(str(ttft) + ",")
             f.write(main_log + ",")
-            f.write(probe_log + "\n")
+            # 探针在主压测里跑，probe_log 这一列也是主压测的日志
+            f.write(main_log + "\n")
 
         qps = qps + QPS_STEP
         time.sleep(2)
 
+    if LIVE_MODE and main_proc is not None:
+        control.stop()
+        stop_main(main_proc, main_log_file)
+
     print("[" + now_string() + "] 全部完成。结果在：", out_path)
     print("CSV：", results_csv)
 
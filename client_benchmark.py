@@ -0,0 +1,279 @@
+"""
+Measures how much load `load_test.py` itself can generate, against mock_server.py.
+
+For every provider path the target QPS is doubled until the client can't keep
+up with it anymore, then bisected between the last sustained and the first
+failed rate. A rate is sustained when the achieved QPS is within
+--min-achieved of the target, at most --max-late-pct of the requests went
+out late and no request failed in Locust's stats. Usage:
+
+    python client_benchmark.py --tokenizer /data/models/Qwen3-8B
+
+With --baseline the results are compared to a previous --output file and the
+script exits with 1 if any path got slower by more than --max-regression.
+"""
+
+import argparse
+import csv
+import datetime
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MODEL = "mock-model"
+
+# provider path -> load_test.py flags
+PATHS = {
+    "openai-chat": ["--provider", "openai", "--chat"],
+    "openai-completions": ["--provider", "openai", "--no-chat"],
+    "openai-chat-no-stream": ["--provider", "openai", "--chat", "--no-stream"],
+    "vllm-chat": ["--provider", "vllm", "--chat"],
+    "vllm-completions": ["--provider", "vllm", "--no-chat"],
+    "fireworks": ["--provider", "fireworks", "--no-chat"],
+    "together": ["--provider", "together", "--no-chat"],
+    "tgi": ["--provider", "tgi", "--no-chat"],
+    "embeddings": ["--provider", "openai", "--embeddings", "--no-stream"],
+}
+
+RESULT_FIELDS = ["path", "max_qps", "tokens_per_s", "target_qps", "late_pct"]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--tokenizer", required=True, help="HF tokenizer for the limerics prompts")
+    parser.add_argument(
+        "--paths",
+        default=",".join(PATHS),
+        help=f"Comma separated provider paths to measure, out of: {', '.join(PATHS)}",
+    )
+    parser.add_argument("--max-tokens", type=int, default=64)
+    parser.add_argument("--prompt-tokens", type=int, default=512)
+    parser.add_argument("--step-time", type=int, default=20, help="Seconds every rate is run for")
+    parser.add_argument("--qps-start", type=float, default=50)
+    parser.add_argument("--qps-max", type=float, default=20000)
+    parser.add_argument(
+        "--refine-steps",
+        type=int,
+        default=3,
+        help="Bisection steps between the last sustained and the first failed rate",
+    )
+    parser.add_argument(
+        "--min-achieved",
+        type=float,
+        default=0.95,
+        help="Fraction of the target QPS that has to be achieved",
+    )
+    parser.add_argument(
+        "--max-late-pct",
+        type=float,
+        default=5.0,
+        help="Max percentage of requests dispatched late, more than LATE_DISPATCH_THRESHOLD_MS of load_test.py after their scheduled time",
+    )
+    parser.add_argument("--ttft", type=float, default=0.0, help="Mock server TTFT in ms")
+    parser.add_argument("--itl", type=float, default=0.0, help="Mock server delay between tokens in ms")
+    parser.add_argument(
+        "--server-workers",
+        type=int,
+        default=max(1, (os.cpu_count() or 2) // 2),
+        help="Mock server processes, enough that the server isn't the bottleneck",
+    )
+    parser.add_argument("--out-dir", default="client_benchmark_results")
+    parser.add_argument("--output", default=None, help="CSV with the results, inside --out-dir by default")
+    parser.add_argument("--baseline", default=None, help="Results CSV of a previous run to compare with")
+    parser.add_argument("--max-regression", type=float, default=0.1)
+    return parser.parse_args()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_mock_server(args, port, log_path):
+    cmd = [
+        sys.executable,
+        os.path.join(HERE, "mock_server.py"),
+        "--port", str(port),
+        "--model", MODEL,
+        "--ttft", str(args.ttft),
+        "--itl", str(args.itl),
+        "--workers", str(args.server_workers),
+    ]
+    log_file = open(log_path, "a")
+    proc = subprocess.Popen(cmd, stdout=log_file, stderr=subprocess.STDOUT)
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 30
+    while True:
+        try:
+            with urllib.request.urlopen(url + "/v1/models", timeout=1):
+                return proc, url
+        except OSError:
+            if proc.poll() is not None or time.time() > deadline:
+                raise RuntimeError(f"Mock server didn't start, see {log_path}")
+            time.sleep(0.2)
+
+
+def read_summary(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, newline="") as f:
+        rows = list(csv.DictReader(f))
+    return rows[-1] if rows else None
+
+
+def read_num_failures(stats_path):
+    """Failed requests in Locust's --csv stats, None when the file is missing."""
+    if not os.path.exists(stats_path):
+        return None
+    with open(stats_path, newline="") as f:
+        for row in csv.DictReader(f):
+            if row["Name"] == "Aggregated":
+                return int(row["Failure Count"])
+    return None
+
+
+def run_step(args, url, name, qps, out_dir):
+    """Runs load_test.py at `qps` and returns (sustained, achieved qps, tokens/s, late %)."""
+    summary_path = os.path.join(out_dir, f"{name}_qps_{qps:g}.csv")
+    csv_prefix = os.path.join(out_dir, f"{name}_qps_{qps:g}_locust")
+    for path in (summary_path, csv_prefix + "_stats.csv"):
+        if os.path.exists(path):
+            os.remove(path)
+    cmd = [
+        sys.executable, "-m", "locust",
+        "-f", os.path.join(HERE, "load_test.py"),
+        "--headless",
+        "-H", url,
+        "--model", MODEL,
+        "--tokenizer", args.tokenizer,
+        "-u", "1",
+        "-r", "1",
+        "--qps", str(qps),
+        "--open-loop",
+        "-t", f"{args.step_time}s",
+        "--max-tokens", str(args.max_tokens),
+        "-p", str(args.prompt_tokens),
+        "--summary-file", summary_path,
+        "--csv", csv_prefix,
+        "--no-print-responses",
+    ] + PATHS[name]
+    with open(os.path.join(out_dir, f"{name}.log"), "a") as log_file:
+        log_file.write(f"CMD: {' '.join(cmd)}\n")
+        log_file.flush()
+        subprocess.run(cmd, stdout=log_file, stderr=subprocess.STDOUT, cwd=HERE)
+
+    num_failures = read_num_failures(csv_prefix + "_stats.csv")
+    if num_failures is None or num_failures > 0:
+        print(f"  {name}: {num_failures if num_failures is not None else 'unknown number of'} failed requests at {qps:g} QPS")
+        return False, 0.0, 0.0, 100.0
+    summary = read_summary(summary_path)
+    if summary is None:
+        # no request completed
+        return False, 0.0, 0.0, 100.0
+    achieved = float(summary["Qps"])
+    num_tokens = float(summary["Num Tokens"] or 0)
+    late_pct = float(summary.get("Late Dispatches Pct") or 0)
+    sustained = achieved >= qps * args.min_achieved and late_pct <= args.max_late_pct
+    return sustained, achieved, achieved * num_tokens, late_pct
+
+
+def measure_path(args, url, name, out_dir):
+    best = None  # (target, achieved, tokens/s, late %)
+    failed_qps = None
+    qps = args.qps_start
+    while qps <= args.qps_max:
+        sustained, achieved, tokens_per_s, late_pct = run_step(args, url, name, qps, out_dir)
+        print(f"  {name}: target {qps:g} QPS -> {achieved:.1f} QPS, {tokens_per_s:.0f} tok/s, {late_pct:.1f}% late {'ok' if sustained else 'FAILED'}")
+        if not sustained:
+            failed_qps = qps
+            break
+        best = (qps, achieved, tokens_per_s, late_pct)
+        qps *= 2
+
+    if best is not None and failed_qps is not None:
+        low, high = best[0], failed_qps
+        for _ in range(args.refine_steps):
+            qps = round((low + high) / 2, 1)
+            sustained, achieved, tokens_per_s, late_pct = run_step(args, url, name, qps, out_dir)
+            print(f"  {name}: target {qps:g} QPS -> {achieved:.1f} QPS, {tokens_per_s:.0f} tok/s, {late_pct:.1f}% late {'ok' if sustained else 'FAILED'}")
+            if sustained:
+                low = qps
+                best = (qps, achieved, tokens_per_s, late_pct)
+            else:
+                high = qps
+
+    if best is None:
+        return {"path": name, "max_qps": 0, "tokens_per_s": 0, "target_qps": 0, "late_pct": ""}
+    return {
+        "path": name,
+        "max_qps": round(best[1], 1),
+        "tokens_per_s": round(best[2]),
+        "target_qps": best[0],
+        "late_pct": round(best[3], 2),
+    }
+
+
+def compare_with_baseline(results, baseline_path, max_regression):
+    with open(baseline_path, newline="") as f:
+        baseline = {row["path"]: row for row in csv.DictReader(f)}
+    regressions = []
+    for row in results:
+        old = baseline.get(row["path"])
+        if old is None or float(old["max_qps"]) <= 0:
+            print(f"{row['path']:<24} no baseline to compare with")
+            continue
+        change = row["max_qps"] / float(old["max_qps"]) - 1
+        print(f"{row['path']:<24} {float(old['max_qps']):>10.1f} -> {row['max_qps']:>10.1f} QPS ({change:+.1%})")
+        if change < -max_regression:
+            regressions.append(row["path"])
+    return regressions
+
+
+def main():
+    args = parse_args()
+    names = [n.strip() for n in args.paths.split(",") if n.strip()]
+    for name in names:
+        if name not in PATHS:
+            raise SystemExit(f"Unknown path {name}, choose from: {', '.join(PATHS)}")
+
+    out_dir = os.path.join(args.out_dir, datetime.datetime.now().strftime("%Y%m%d_%H%M%S"))
+    os.makedirs(out_dir, exist_ok=True)
+    output = args.output or os.path.join(out_dir, "results.csv")
+
+    port = free_port()
+    server, url = start_mock_server(args, port, os.path.join(out_dir, "mock_server.log"))
+    print(f"Mock server at {url} with {args.server_workers} workers, ttft {args.ttft} ms, itl {args.itl} ms")
+    results = []
+    try:
+        for name in names:
+            print(f"Measuring {name}")
+            results.append(measure_path(args, url, name, out_dir))
+    finally:
+        server.terminate()
+        server.wait()
+
+    with open(output, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS)
+        writer.writeheader()
+        writer.writerows(results)
+
+    print(" Client capacity ".center(60, "="))
+    for row in results:
+        print(f"{row['path']:<24} {row['max_qps']:>10} QPS {row['tokens_per_s']:>12} tok/s")
+    print("=" * 60)
+    print(f"Results in {output}")
+
+    if args.baseline:
+        regressions = compare_with_baseline(results, args.baseline, args.max_regression)
+        if regressions:
+            print(f"Regressed by more than {args.max_regression:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+Client for the control endpoint of a running load test (load_test.py --control-port).
+
+    control = LoadTestControl(8089)
+    control.wait_ready()
+    control.set(qps=20, users=30)
+    ...
+    control.set(reset_stats=True)
+    print(control.stats()["summary"]["Time To First Token"])
+    control.stop()
+"""
+
+import json
+import time
+import urllib.error
+import urllib.request
+
+
+class LoadTestControl:
+    def __init__(self, port, host="127.0.0.1", timeout=10.0):
+        self.url = f"http://{host}:{port}"
+        self.timeout = timeout
+
+    def _request(self, method, path, data=None):
+        body = None if data is None else json.dumps(data).encode()
+        request = urllib.request.Request(
+            self.url + path,
+            data=body,
+            method=method,
+            headers={"Content-Type": "application/json"},
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            raise RuntimeError(f"{method} {path} failed: {e.code} {e.read().decode()}") from e
+
+    def wait_ready(self, timeout=300.0):
+        """Waits for the load test to start listening, it loads the tokenizer and the dataset first."""
+        deadline = time.time() + timeout
+        while True:
+            try:
+                return self.stats()
+            except (OSError, RuntimeError):
+                if time.time() > deadline:
+                    raise
+                time.sleep(1)
+
+    def stats(self):
+        """Returns {"qps", "users", "num_failures", "summary"} since the last stats reset.
+
+        num_failures counts the main load only, failed probe requests are in the summary.
+        """
+        return self._request("GET", "/stats")
+
+    def set(self, qps=None, users=None, spawn_rate=None, reset_stats=False):
+        """Changes the load, the stats are reset after the change (after the ramp with `users`) if asked to."""
+        data = {}
+        if qps is not None:
+            data["qps"] = qps
+        if users is not None:
+            data["users"] = users
+        if spawn_rate is not None:
+            data["spawn_rate"] = spawn_rate
+        if reset_stats:
+            data["reset_stats"] = True
+        return self._request("POST", "/control", data)
+
+    def stop(self):
+        try:
+            self._request("POST", "/stop", {})
+        except OSError:
+            # already gone
+            pass
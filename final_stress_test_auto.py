@@ -2,26 +2,20 @@ import subprocess
 import time
 import datetime
 import os
-import re
 import argparse
 import csv
 from pathlib import Path
 
+from control_client import LoadTestControl
+from plateau_detector import PlateauDetector
+from prom_scraper import PromScraper
+
 DESKTOP_DIR = os.path.expanduser("~/Desktop")
 DEFAULT_HOST = "http://127.0.0.1:8000"
 OUT_DIR = "auto_results"
 
-METRICS_CMD_TEMPLATE = (
-    "{curl} -s {host}/metrics | "
-    "grep 'vllm:num_requests_running' | "
-    "tail -n 1"
-)
-
-METRICS_WAITING_CMD_TEMPLATE = (
-    "{curl} -s {host}/metrics | "
-    "grep 'vllm:num_requests_waiting' | "
-    "tail -n 1"
-)
+# 每个 host 一个抓 /metrics 的长连接
+SCRAPERS = {}
 
 def now_string():
     return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -71,15 +65,20 @@ def parse_args():
     parser.add_argument("--qps-max", type=int, default=200)
 
     # 平台期参数
-    parser.add_argument("--plateau-seconds", type=int, default=15)
-    parser.add_argument("--poll-seconds", type=int, default=1)
+    parser.add_argument("--plateau-seconds", type=float, default=30, help="平台期判定的滑动窗口长度（秒）")
+    parser.add_argument("--plateau-min-seconds", type=float, default=30, help="每一轮至少观察多久才判平台期")
+    parser.add_argument("--plateau-max-seconds", type=float, default=600, help="超过这个时间还没稳定就直接结束这一轮")
+    parser.add_argument("--plateau-slope", type=float, default=0.05, help="窗口内趋势变化量占均值的比例上限")
+    parser.add_argument("--plateau-cv", type=float, default=0.25, help="窗口内变异系数（标准差/均值）上限")
+    parser.add_argument("--poll-seconds", type=float, default=1)
 
     # locust 运行时间与 token 参数
     parser.add_argument("--main-runtime-seconds", type=int, default=99999)
-    parser.add_argument("--probe-runtime-seconds", type=int, default=120)
+    parser.add_argument("--probe-runtime-seconds", type=int, default=120, help="平台期之后统计探针 TTFT 的时长（秒）")
 
     parser.add_argument("--main-max-tokens", type=int, default=1000)
     parser.add_argument("--probe-max-tokens", type=int, default=100)
+    parser.add_argument("--probe-qps", type=float, default=1, help="主压测里探针请求的 QPS（load_test.py --probe-qps）")
 
     # users / spawn_rate 与 qps 的倍率
     parser.add_argument("--users-multiplier", type=float, default=1.5)
@@ -88,6 +87,38 @@ def parse_args():
     # 可选：curl 可指定
     parser.add_argument("--curl-bin", default="curl")
 
+    # SLO（毫秒），设置任意一个后主压测会统计 goodput，goodput 过了峰值就停止扫描
+    parser.add_argument("--slo-ttft", type=float, default=None)
+    parser.add_argument("--slo-tpot", type=float, default=None)
+    parser.add_argument("--slo-e2e", type=float, default=None)
+    # 主压测都带 --control-port，平台期后通过它清零统计、读探针 TTFT 和 goodput
+    # live 模式：整个扫描只启动一次主压测，每一步通过控制端口直接改 QPS / users
+    parser.add_argument("--live", action="store_true")
+    parser.add_argument("--control-port", type=int, default=8089)
+
+    # 扫描方式：linear = 从 qps-start 每次加 qps-step；adaptive = 先翻倍找区间，再二分找拐点
+    parser.add_argument("--search", choices=["linear", "adaptive"], default="linear")
+    parser.add_argument(
+        "--criterion",
+        choices=["ttft", "waiting", "goodput"],
+        default="ttft",
+        help="adaptive 模式下判断“饱和”的标准：ttft = 探针 TTFT 超过 --ttft-threshold；"
+             "waiting = 平台期 num_requests_waiting > 0；goodput = goodput 低于 QPS 的 (1 - --goodput-drop)"
+    )
+    parser.add_argument("--ttft-threshold", type=float, default=1000.0, help="探针 TTFT 阈值（毫秒）")
+    parser.add_argument(
+        "--search-tolerance",
+        type=float,
+        default=1.0,
+        help="二分到区间宽度小于这个 QPS 就停止"
+    )
+    parser.add_argument(
+        "--goodput-drop",
+        type=float,
+        default=0.1,
+        help="goodput 比峰值低这个比例（默认 0.1 = 10%%）就认为过了峰值，停止扫描"
+    )
+
     return parser.parse_args()
 
 
@@ -179,43 +210,117 @@ def wait_for_ready(args, host, timeout_seconds):
         time.sleep(2)
 
 
-def get_num_requests_running(args, host):
-    metrics_cmd = METRICS_CMD_TEMPLATE.format(curl=args.curl_bin, host=host.rstrip("/"))
-    line = subprocess.getoutput(metrics_cmd).strip()
-    if line == "":
-        return None
+def get_metrics(args, host):
+    """一次请求拿到 running / waiting / KV cache 使用率 / 抢占 / 前缀缓存命中等，失败返回 None"""
+    host = host.rstrip("/")
+    if host not in SCRAPERS:
+        SCRAPERS[host] = PromScraper(host)
+    return SCRAPERS[host].try_scrape()
 
-    parts = line.split()
-    if len(parts) < 2:
-        return None
 
-    try:
-        return float(parts[-1])
-    except ValueError:
+def get_num_requests_running(args, host):
+    snapshot = get_metrics(args, host)
+    if snapshot is None:
         return None
+    return snapshot.running
+
 
 def get_num_requests_waiting(args, host):
-    metrics_cmd = METRICS_WAITING_CMD_TEMPLATE.format(
-        curl=args.curl_bin,
-        host=host.rstrip("/")
-    )
-    line = subprocess.getoutput(metrics_cmd).strip()
-    if line == "":
+    snapshot = get_metrics(args, host)
+    if snapshot is None:
         return None
+    return snapshot.waiting
+
+def is_saturated(args, result):
+    """按 --criterion 判断这个 QPS 是否已经饱和"""
+    if args.criterion == "ttft":
+        # 探针没拿到 TTFT 也算饱和
+        if result["ttft"] is None:
+            return True
+        return float(result["ttft"]) > args.ttft_threshold
+    if args.criterion == "waiting":
+        return result["waiting"] is not None and result["waiting"] > 0
+    # goodput 跟不上发送的 QPS，说明很多请求已经达不到 SLO
+    return result["goodput"] < result["qps"] * (1 - args.goodput_drop)
+
+
+def adaptive_search(args, run_step):
+    """
+    1) 从 qps-start 开始翻倍，直到饱和（或到 qps-max），得到区间 [low, high]
+    2) 在区间里二分，直到 high - low <= search-tolerance
+    返回没饱和的最大 QPS（拐点），qps-start 就饱和时返回 None
+    """
+    if args.criterion == "goodput" and len(slo_flags(args)) == 0:
+        raise RuntimeError("--criterion goodput 需要设置 --slo-ttft / --slo-tpot / --slo-e2e")
+    if args.qps_start <= 0:
+        raise RuntimeError("--qps-start 必须大于 0（翻倍搜索从它开始）")
 
-    parts = line.split()
-    if len(parts) < 2:
-        return None
+    low = None
+    high = None
+    qps = args.qps_start
+    while True:
+        result = run_step(qps)
+        if is_saturated(args, result):
+            high = qps
+            break
+        low = qps
+        if qps >= args.qps_max:
+            break
+        qps = min(qps * 2, args.qps_max)
 
-    try:
-        return float(parts[-1])
-    except ValueError:
+    if high is None:
+        print("[" + now_string() + "] 到 qps-max =", args.qps_max, "都没有饱和")
+        return low
+
+    if low is None:
+        low = 0
+    while high - low > args.search_tolerance:
+        qps = round((low + high) / 2, 1)
+        if qps <= low or qps >= high:
+            break
+        result = run_step(qps)
+        if is_saturated(args, result):
+            high = qps
+        else:
+            low = qps
+        print("[" + now_string() + "] 当前区间：[{l}, {h}]".format(l=low, h=high))
+
+    if low == 0:
+        print("[" + now_string() + "] qps-start 就已经饱和，拐点低于", high)
         return None
+    print("[" + now_string() + "] 拐点：QPS = {l}（{h} 时饱和，判断标准 = {c}）".format(
+        l=low, h=high, c=args.criterion))
+    return low
+
+
+def slo_flags(args):
+    flags = []
+    if args.slo_ttft is not None:
+        flags += ["--slo-ttft", str(args.slo_ttft)]
+    if args.slo_tpot is not None:
+        flags += ["--slo-tpot", str(args.slo_tpot)]
+    if args.slo_e2e is not None:
+        flags += ["--slo-e2e", str(args.slo_e2e)]
+    return flags
+
+
+def format_metrics(snapshot):
+    if snapshot is None:
+        return "running=None"
+    return "running={r} waiting={w} kv={kv} preemptions={p} prefix_hits={h}/{q}".format(
+        r=snapshot.running,
+        w=snapshot.waiting,
+        kv=snapshot.kv_cache_usage,
+        p=snapshot.preemptions,
+        h=snapshot.prefix_cache_hits,
+        q=snapshot.prefix_cache_queries,
+    )
+
 
 def build_main_locust_cmd(args, host, model_path, tokenizer_path,
                           users, spawn_rate, qps,
                           run_time_s, max_tokens,
-                          extra_flags):
+                          extra_flags, summary_path=None):
     cmd = [
         args.locust_bin,                 # <- 用 venv 的 locust
         "-f", "load_test.py",
@@ -229,32 +334,14 @@ def build_main_locust_cmd(args, host, model_path, tokenizer_path,
         "--qps", str(qps),
         "-t", str(run_time_s) + "s",
         "--max-tokens", str(max_tokens),
-    ]
-
-    if extra_flags is not None:
-        for item in extra_flags:
-            cmd.append(item)
-
-    return cmd
+        # 探针直接跑在主压测里，TTFT 通过控制端口读
+        "--probe-qps", str(args.probe_qps),
+        "--probe-max-tokens", str(args.probe_max_tokens),
+        "--control-port", str(args.control_port),
+    ] + slo_flags(args)
 
-
-def build_probe_locust_cmd(args, host, model_path, tokenizer_path,
-                           run_time_s, max_tokens,
-                           extra_flags):
-    cmd = [
-        args.locust_bin,                 # <- 用 venv 的 locust
-        "-f", "load_test.py",
-        "--headless",
-        "-H", host,
-        "--provider", "vllm",
-        "--model", model_path,
-        "--tokenizer", tokenizer_path,
-        "-u", "1",
-        "-r", "1",
-        "--qps", "1",
-        "-t", str(run_time_s) + "s",
-        "--max-tokens", str(max_tokens),
-    ]
+    if summary_path is not None:
+        cmd += ["--summary-file", summary_path]
 
     if extra_flags is not None:
         for item in extra_flags:
@@ -276,50 +363,32 @@ def start_main_locust(cmd, main_log_path):
     return proc, log_file
 
 
-def run_probe_and_get_ttft(cmd, probe_log_path):
-    print("[" + now_string() + "] 开始探针（" + cmd[cmd.index("-t") + 1] + "）...")
-
-    result = subprocess.run(
-        cmd,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-        text=True
-    )
-
-    with open(probe_log_path, "a", encoding="utf-8") as f:
-        f.write("[" + now_string() + "] PROBE CMD: " + " ".join(cmd) + "\n")
-        f.write(result.stdout)
-        f.write("\n")
-
-    ttft_value = None
-    for line in result.stdout.splitlines():
-        line_stripped = line.strip()
-        line_lower = line_stripped.lower()
-
-    # 只抓这一行：Time To First Token : <number>
-    # 排除：P50 Time To First Token : <number>
-    # 排除：METRIC time_to_first_token ...（没有冒号，且不以 time to first token 开头）
-        if line_lower.startswith("time to first token") and ":" in line_lower:
-        # 排除分位数行（P50/P90/...）
-            if line_lower.startswith("p"):
+def measure_probe(control, probe_seconds):
+    """平台期后清零统计，再跑 probe_seconds 秒，返回 (探针 TTFT, 这段时间的统计)"""
+    control.set(reset_stats=True)
+    print("[" + now_string() + "] 开始探针统计（" + str(probe_seconds) + "s）...")
+    time.sleep(probe_seconds)
 
-                continue
-
-
-            nums = re.findall(r"[0-9]+(?:\.[0-9]+)?", line_stripped)
-            if len(nums) > 0:
-                ttft_value = nums[-1]
-
-    return ttft_value
+    stats = control.stats()
+    ttft = stats["summary"].get("Probe Time To First Token")
+    if ttft == "":
+        # 这段时间没有探针请求成功
+        ttft = None
+    return ttft, stats
 
 
 def stop_main(proc, log_file):
     print("[" + now_string() + "] 停止主压测...")
     if proc.poll() is None:
         proc.terminate()
-        time.sleep(2)
+        # locust 收到 TERM 后会写 summary，等它自己退出
+        try:
+            proc.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            pass
     if proc.poll() is None:
         proc.kill()
+        proc.wait()
 
     try:
         log_file.close()
@@ -331,10 +400,11 @@ def wait_until_plateau(args, host, watcher_log_path, poll_seconds, plateau_secon
     print("[" + now_string() + "] 等待 num_requests_running 先变成 > 0 (证明主压测真的打到了模型)...")
 
     while True:
-        cur = get_num_requests_running(args, host)
+        snapshot = get_metrics(args, host)
+        cur = snapshot.running if snapshot is not None else None
 
         with open(watcher_log_path, "a", encoding="utf-8") as f:
-            f.write("[" + now_string() + "] running=" + str(cur) + "\n")
+            f.write("[" + now_string() + "] " + format_metrics(snapshot) + "\n")
 
         print("[" + now_string() + "] 当前 num_requests_running =", cur)
 
@@ -343,37 +413,48 @@ def wait_until_plateau(args, host, watcher_log_path, poll_seconds, plateau_secon
 
         time.sleep(poll_seconds)
 
-    last_value = cur
-    last_increase_time = time.time()
+    # 平台期：滑动窗口内 running / waiting / KV 使用率 / 完成速率 都没有显著趋势且波动不大
+    detector = PlateauDetector(
+        window_seconds=plateau_seconds,
+        min_seconds=args.plateau_min_seconds,
+        max_seconds=args.plateau_max_seconds,
+        slope_tolerance=args.plateau_slope,
+        cv_tolerance=args.plateau_cv,
+    )
+    detector.observe_snapshot(snapshot)
 
-    print("[" + now_string() + "] 已确认主压测在打请求，开始平台期检测（{s}秒不增长）...".format(s=plateau_seconds))
+    print("[" + now_string() + "] 已确认主压测在打请求，开始平台期检测（窗口 {s} 秒，最短 {a} 秒，最长 {b} 秒）...".format(
+        s=plateau_seconds, a=detector.min_seconds, b=args.plateau_max_seconds))
 
     while True:
-        cur = get_num_requests_running(args, host)
-        now = time.time()
+        time.sleep(poll_seconds)
 
-        with open(watcher_log_path, "a", encoding="utf-8") as f:
-            f.write("[" + now_string() + "] running=" + str(cur) + "\n")
+        snapshot = get_metrics(args, host)
+        detector.observe_snapshot(snapshot)
+        done, reason = detector.check()
 
-        print("[" + now_string() + "] 当前 num_requests_running =", cur)
+        with open(watcher_log_path, "a", encoding="utf-8") as f:
+            f.write("[" + now_string() + "] " + format_metrics(snapshot) + "\n")
 
-        if cur is not None and cur > last_value:
-            last_value = cur
-            last_increase_time = now
+        print("[" + now_string() + "] 当前 num_requests_running =", snapshot.running if snapshot is not None else None)
 
-        if now - last_increase_time >= plateau_seconds:
-            print("[" + now_string() + "] 连续 {s} 秒不增长，平台期到了。".format(s=plateau_seconds))
+        if done:
+            print("[" + now_string() + "] 平台期判定：" + reason)
 
-            final_running = last_value
-            final_waiting = get_num_requests_waiting(args, host)
+            # 取窗口内的均值，单个尖峰不影响结果
+            final_running = detector.mean("running")
+            final_waiting = detector.mean("waiting")
+            if final_running is not None:
+                final_running = round(final_running, 1)
+            if final_waiting is not None:
+                final_waiting = round(final_waiting, 1)
 
             with open(watcher_log_path, "a", encoding="utf-8") as f:
-                f.write("[" + now_string() + "] waiting=" + str(final_waiting) + "\n")
+                f.write("[" + now_string() + "] " + reason + "\n")
+                f.write("[" + now_string() + "] running=" + str(final_running) + " waiting=" + str(final_waiting) + "\n")
 
             return final_running, final_waiting
 
-        time.sleep(poll_seconds)
-
 
 def main():
     args = parse_args()
@@ -396,7 +477,6 @@ def main():
             "tokenizer_path": "/data/models/Qwen3-8B",
             "serve_cmd": "vllm serve /data/models/Qwen3-8B --host 0.0.0.0 --port 8000",
             "main_extra_flags": [],
-            "probe_extra_flags": [],
         }
     }
 
@@ -412,7 +492,6 @@ def main():
     tokenizer_path = model_conf["tokenizer_path"]
     serve_cmd = model_conf["serve_cmd"]
     main_extra_flags = model_conf["main_extra_flags"]
-    probe_extra_flags = model_conf["probe_extra_flags"]
 
     pid_file_path = "/tmp/vllm_serve.pid"
     log_file_path = "/tmp/vllm_serve.log"
@@ -426,7 +505,7 @@ def main():
 
     with open(results_csv, "w", encoding="utf-8") as f:
         #f.write("time,model_key,main_qps,plateau_running,probe_ttft,test_time,main_log,probe_log\n")
-        f.write("qps,user,spawn,run,wait,probe_ttft,test_time,probe_log\n")
+        f.write("qps,user,spawn,run,wait,probe_ttft,test_time,probe_log,goodput\n")
 
     # 1) 启动 vLLM（容器内）
     if not args.skip_start_server:
@@ -444,76 +523,125 @@ def main():
     wait_for_ready(args, args.host, args.ready_timeout_seconds)
 
     # 3) QPS 扫描
-    qps = args.qps_start
+    use_goodput = len(slo_flags(args)) > 0
+    # live 模式下一直在跑的主压测
+    live = {"proc": None, "log_file": None, "control": None}
 
-    try:
-        while qps <= args.qps_max:
-            print("\n==============================")
-            print("[" + now_string() + "] 新一轮开始：model =", args.model_key, "main QPS =", qps)
-            print("==============================\n")
-
-            users = int(qps * args.users_multiplier)
-            spawn_rate = int(qps * args.spawn_multiplier)
-
-            main_log = os.path.join(out_path, "main_qps_" + str(qps) + ".log")
-            probe_log = os.path.join(out_path, "probe_at_qps_" + str(qps) + ".log")
-
-            main_cmd = build_main_locust_cmd(
-                args=args,
-                host=args.host,
-                model_path=model_path,
-                tokenizer_path=tokenizer_path,
-                users=users,
-                spawn_rate=spawn_rate,
-                qps=qps,
-                run_time_s=args.main_runtime_seconds,
-                max_tokens=args.main_max_tokens,
-                extra_flags=main_extra_flags
-            )
+    def run_step(qps):
+        """跑一个 QPS：主压测（带探针） -> 等平台期 -> 清零统计后读探针 TTFT -> 停主压测，结果写进 results.csv"""
+        print("\n==============================")
+        print("[" + now_string() + "] 新一轮开始：model =", args.model_key, "main QPS =", qps)
+        print("==============================\n")
 
-            probe_cmd = build_probe_locust_cmd(
-                args=args,
-                host=args.host,
-                model_path=model_path,
-                tokenizer_path=tokenizer_path,
-                run_time_s=args.probe_runtime_seconds,
-                max_tokens=args.probe_max_tokens,
-                extra_flags=probe_extra_flags
-            )
+        users = int(qps * args.users_multiplier)
+        spawn_rate = int(qps * args.spawn_multiplier)
 
+        main_log = os.path.join(out_path, "main_qps_" + str(qps) + ".log")
+        summary_path = os.path.join(out_path, "summary_qps_" + str(qps) + ".csv")
+
+        main_cmd = build_main_locust_cmd(
+            args=args,
+            host=args.host,
+            model_path=model_path,
+            tokenizer_path=tokenizer_path,
+            users=users,
+            spawn_rate=spawn_rate,
+            qps=qps,
+            run_time_s=args.main_runtime_seconds,
+            max_tokens=args.main_max_tokens,
+            extra_flags=main_extra_flags,
+            summary_path=summary_path
+        )
+
+        if not args.live:
             main_proc, main_log_file = start_main_locust(main_cmd, main_log)
+            control = LoadTestControl(args.control_port)
+            control.wait_ready()
+        elif live["proc"] is None:
+            main_log = os.path.join(out_path, "main_live.log")
+            live["proc"], live["log_file"] = start_main_locust(main_cmd, main_log)
+            live["control"] = LoadTestControl(args.control_port)
+            live["control"].wait_ready()
+            control = live["control"]
+        else:
+            print("[" + now_string() + "] 在线调整主压测：QPS =", qps, "users =", users)
+            control = live["control"]
+            control.set(qps=qps, users=users, spawn_rate=spawn_rate)
 
-            plateau_value, plateau_waiting = wait_until_plateau(
-                args=args,
-                host=args.host,
-                watcher_log_path=watcher_log,
-                poll_seconds=args.poll_seconds,
-                plateau_seconds=args.plateau_seconds
-            )
+        plateau_value, plateau_waiting = wait_until_plateau(
+            args=args,
+            host=args.host,
+            watcher_log_path=watcher_log,
+            poll_seconds=args.poll_seconds,
+            plateau_seconds=args.plateau_seconds
+        )
 
-            ttft = run_probe_and_get_ttft(probe_cmd, probe_log)
-            print("[" + now_string() + "] 探针结束，TTFT =", ttft)
+        # 统计从平台期开始算
+        ttft, stats = measure_probe(control, args.probe_runtime_seconds)
+        print("[" + now_string() + "] 探针结束，TTFT =", ttft)
 
+        goodput = None
+        if use_goodput and stats["num_failures"] == 0:
+            goodput = stats["summary"].get("Goodput")
+
+        if not args.live:
+            control.stop()
             stop_main(main_proc, main_log_file)
+        if use_goodput:
+            # 有失败请求时按 goodput = 0 处理
+            print("[" + now_string() + "] goodput =", goodput, "req/s")
+
+        with open(results_csv, "a", encoding="utf-8") as f:
+            f.write(str(qps) + ",")
+            f.write(str(users) + ",")
+            f.write(str(spawn_rate) + ",")
+            #f.write(now_string() + ",")
+            #f.write(args.model_key + ",")
+            #f.write(str(qps) + ",")
+            f.write(str(plateau_value) + ",")
+            f.write(str(plateau_waiting) + ",")
+            f.write(str(ttft) + ",")
+            f.write(str(args.probe_runtime_seconds) + ",")
+            # 探针在主压测里跑，probe_log 这一列现在是主压测的日志
+            f.write(main_log + ",")
+            f.write(str(goodput) + "\n")
+
+        time.sleep(2)
+        return {
+            "qps": qps,
+            "running": plateau_value,
+            "waiting": plateau_waiting,
+            "ttft": ttft,
+            "goodput": 0.0 if use_goodput and goodput is None else goodput,
+        }
 
-            with open(results_csv, "a", encoding="utf-8") as f:
-                f.write(str(qps) + ",")
-                f.write(str(users) + ",")               
-                f.write(str(spawn_rate) + ",")
-                #f.write(now_string() + ",")
-                #f.write(args.model_key + ",")
-                #f.write(str(qps) + ",")
-                f.write(str(plateau_value) + ",")
-                f.write(str(plateau_waiting) + ",")
-                f.write(str(ttft) + ",")
-                f.write(str(args.probe_runtime_seconds) + ",")
-                #f.write(main_log + ",")
-                f.write(probe_log + "\n")
-
-            qps = qps + args.qps_step
-            time.sleep(2)
+    try:
+        if args.search == "adaptive":
+            adaptive_search(args, run_step)
+        else:
+            best_goodput = None
+            best_goodput_qps = None
+            qps = args.qps_start
+            while qps <= args.qps_max:
+                result = run_step(qps)
+
+                if use_goodput:
+                    goodput = result["goodput"]
+                    if best_goodput is None or goodput > best_goodput:
+                        best_goodput = goodput
+                        best_goodput_qps = qps
+                    elif goodput < best_goodput * (1 - args.goodput_drop):
+                        print("[" + now_string() + "] goodput 已过峰值：最高 {g} req/s（QPS = {q}），停止扫描".format(
+                            g=best_goodput, q=best_goodput_qps))
+                        break
+
+                qps = qps + args.qps_step
 
     finally:
+        if live["proc"] is not None:
+            live["control"].stop()
+            stop_main(live["proc"], live["log_file"])
+
         # 4) 停 vLLM（容器内）
         if not args.skip_stop_server:
             stop_vllm_in_container(args, args.container_name, pid_file_path)
@@ -0,0 +1,116 @@
+"""
+Pool of distinct synthetic images for vision benchmarks.
+
+Kept free of Locust imports so that the worker processes rendering the images
+only need PIL.
+"""
+
+import base64
+import io
+import multiprocessing
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+
+# Noise is generated at a fraction of the resolution and upscaled, so images
+# compress (and cost to decode) more like photos than like pure noise
+NOISE_DOWNSCALE = 8
+JPEG_QUALITY = 90
+
+
+def render_noise_jpeg(width, height, seed):
+    """Renders a deterministic pseudo-random JPEG of the given size."""
+    rng = random.Random(seed)
+    small = (
+        max(1, width // NOISE_DOWNSCALE),
+        max(1, height // NOISE_DOWNSCALE),
+    )
+    img = Image.frombytes("RGB", small, rng.randbytes(small[0] * small[1] * 3))
+    img = img.resize((width, height), Image.BICUBIC)
+    buffer = io.BytesIO()
+    img.save(buffer, format="JPEG", quality=JPEG_QUALITY)
+    return buffer.getvalue()
+
+
+class ImagePool:
+    """`pool_size` distinct images for every requested resolution, shared by the process.
+
+    Every request gets a randomly picked image per resolution, so as long as the
+    pool is larger than the server's multimodal cache, the server can't serve its
+    preprocessing from that cache the way it can with identical images.
+    Missing images are rendered in a process pool and stored in `cache_dir`.
+    """
+
+    _instance = None
+
+    def __init__(self, resolutions, pool_size, cache_dir=None, seed=0):
+        self.resolutions = resolutions
+        self.pool_size = pool_size
+
+        # (width, height, seed of the image), the seed also names the cache file
+        jobs = [
+            (width, height, f"{seed}-{width}x{height}-{i}")
+            for width, height in resolutions
+            for i in range(pool_size)
+        ]
+
+        images = {}
+        missing = []
+        for job in jobs:
+            path = self._cache_path(cache_dir, job[2])
+            if path and os.path.exists(path):
+                with open(path, "rb") as f:
+                    images[job] = f.read()
+            else:
+                missing.append(job)
+
+        if missing:
+            print(f"Rendering {len(missing)} images for the prompt image pool")
+            # spawn so the workers don't inherit the monkey-patched gevent state
+            with ProcessPoolExecutor(
+                mp_context=multiprocessing.get_context("spawn")
+            ) as executor:
+                rendered = executor.map(render_noise_jpeg, *zip(*missing))
+                for job, data in zip(missing, rendered):
+                    images[job] = data
+                    self._save(self._cache_path(cache_dir, job[2]), data)
+
+        self._images = [
+            [self._to_data_uri(images[job]) for job in jobs[i : i + pool_size]]
+            for i in range(0, len(jobs), pool_size)
+        ]
+
+    @classmethod
+    def get_instance(cls, resolutions, pool_size, cache_dir=None, seed=0):
+        if cls._instance is None:
+            cls._instance = cls(resolutions, pool_size, cache_dir, seed)
+        return cls._instance
+
+    @staticmethod
+    def _cache_path(cache_dir, image_seed):
+        if not cache_dir:
+            return None
+        return os.path.join(cache_dir, "images", f"noise-{image_seed}.jpg")
+
+    @staticmethod
+    def _save(path, data):
+        if not path:
+            return
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"WARNING: can't write image cache {path}: {e}")
+
+    @staticmethod
+    def _to_data_uri(data):
+        return f"data:image/jpeg;base64,{base64.b64encode(data).decode('utf-8')}"
+
+    def sample(self):
+        """Returns one randomly picked image per resolution as base64 data URIs."""
+        return [random.choice(images) for images in self._images]
@@ -1,5 +1,6 @@
 import abc
 import argparse
+from array import array
 import csv
 from dataclasses import dataclass
 from functools import partial
@@ -9,17 +10,26 @@ import sys
 import traceback
 from typing import Optional
 from locust import HttpUser, task, events, constant_pacing
+from locust.exception import StopUser
+from locust.runners import MasterRunner, WorkerRunner, STATE_MISSING
 import copy
+import datetime
 import json
 import time
 import orjson
-import base64
-import io
 import itertools
-from PIL import Image
-import transformers
+import math
+import mmap
+import struct
+from image_pool import ImagePool
 import re
+import hashlib
 import gevent
+import gevent.lock
+import gevent.pool
+import gevent.pywsgi
+import gevent.threadpool
+from requests.adapters import HTTPAdapter
 from locust.util.timespan import parse_timespan as _locust_parse_timespan
 
 try:
@@ -28,22 +38,502 @@ except ImportError:
     print("locust-plugins is not installed, Grafana won't work")
 
 
-def add_custom_metric(name, value, length_value=0):
-    events.request.fire(
-        request_type="METRIC",
-        name=name,
-        response_time=value,
-        response_length=length_value,
-        exception=None,
-        context=None,
-    )
+class HdrHistogram:
+    """Log-linear histogram with a fixed number of significant digits (like HdrHistogram).
+
+    Values are stored as integer multiples of `unit` in buckets whose width grows with
+    the magnitude of the value, so the relative error stays below 10^-digits over the
+    whole range. Memory only depends on the range of values, not on their number, and
+    histograms with the same parameters can be merged exactly.
+    """
+
+    def __init__(self, significant_digits=3, unit=0.001):
+        self.significant_digits = significant_digits
+        self.unit = unit
+        sub_bucket_count = 1 << math.ceil(math.log2(2 * 10**significant_digits))
+        self._sub_bucket_bits = sub_bucket_count.bit_length() - 1
+        self._half_count = sub_bucket_count >> 1
+        self.counts = {}
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def _index(self, x):
+        shift = x.bit_length() - self._sub_bucket_bits
+        if shift <= 0:
+            return x
+        return shift * self._half_count + (x >> shift)
+
+    def _bucket_value(self, index):
+        if index < 2 * self._half_count:
+            return index
+        shift = index // self._half_count - 1
+        sub_bucket = index - shift * self._half_count
+        # middle of the bucket
+        return (sub_bucket << shift) + ((1 << shift) - 1) / 2
+
+    def record(self, value):
+        index = self._index(int(value / self.unit + 0.5) if value > 0 else 0)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else 0
+
+    def percentile(self, q):
+        """Returns the value below which `q` (0..1) of the samples fall."""
+        if not self.count:
+            return 0
+        if q >= 1:
+            return self.max
+        target = q * self.count
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= target:
+                value = self._bucket_value(index) * self.unit
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def to_dict(self):
+        """Serializes the histogram into plain types that can be sent between processes."""
+        return {
+            "significant_digits": self.significant_digits,
+            "unit": self.unit,
+            "indexes": list(self.counts.keys()),
+            "counts": list(self.counts.values()),
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min,
+            "max": self.max,
+        }
+
+    def merge_dict(self, data):
+        assert (
+            data["significant_digits"] == self.significant_digits
+            and data["unit"] == self.unit
+        ), "Can't merge histograms with different precision"
+        for index, count in zip(data["indexes"], data["counts"]):
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.count += data["count"]
+        self.sum += data["sum"]
+        if data["min"] is not None and (self.min is None or data["min"] < self.min):
+            self.min = data["min"]
+        if data["max"] is not None and (self.max is None or data["max"] > self.max):
+            self.max = data["max"]
+
+
+class CustomMetrics:
+    """Process-wide store of the derived per-request metrics (TTFT, ITL, token counts, ...).
+
+    Locust's own stats are only used for the HTTP requests themselves.
+    """
+
+    histograms = {}
+    start_time = time.time()
+    last_record_time = None
+
+    @classmethod
+    def get(cls, name):
+        histogram = cls.histograms.get(name)
+        if histogram is None:
+            histogram = cls.histograms[name] = HdrHistogram()
+        return histogram
+
+    @classmethod
+    def record(cls, name, value):
+        cls.get(name).record(value)
+        cls.last_record_time = time.time()
+        if TimeSeries._instance is not None:
+            TimeSeries._instance.record(name, value)
+
+    @classmethod
+    def elapsed(cls):
+        """Seconds from the last reset to the last recorded sample."""
+        if cls.last_record_time is None:
+            return 0
+        return cls.last_record_time - cls.start_time
+
+    @classmethod
+    def rate(cls, name):
+        """Samples per second of the metric since the last reset."""
+        elapsed = cls.elapsed()
+        return cls.get(name).count / elapsed if elapsed > 0 else 0
+
+    @classmethod
+    def sum_rate(cls, name):
+        """Sum of the metric's samples per second since the last reset."""
+        elapsed = cls.elapsed()
+        return cls.get(name).sum / elapsed if elapsed > 0 else 0
+
+    @classmethod
+    def reset(cls):
+        cls.histograms = {}
+        cls.start_time = time.time()
+        cls.last_record_time = None
+
+
+def add_custom_metric(name, value):
+    CustomMetrics.record(name, value)
+
+
+def add_custom_metric_values(name, values):
+    """Records many samples of a metric at once (used for per-chunk metrics)."""
+    histogram = CustomMetrics.get(name)
+    for value in values:
+        histogram.record(value)
+    if TimeSeries._instance is not None:
+        for value in values:
+            TimeSeries._instance.record(name, value)
+
+
+@events.reset_stats.add_listener
+def _reset_custom_metrics():
+    CustomMetrics.reset()
+
+
+def _worker_output_path(path):
+    """Gives every worker its own output file in distributed mode."""
+    if isinstance(InitTracker.environment.runner, WorkerRunner):
+        root, ext = os.path.splitext(path)
+        return f"{root}.worker{InitTracker.worker_index}{ext}"
+    return path
+
+
+def _slo_thresholds(options):
+    """Returns the --slo-* thresholds that are set, in ms by the short name of the SLO."""
+    thresholds = {
+        "ttft": options.slo_ttft,
+        "tpot": options.slo_tpot,
+        "e2e": options.slo_e2e,
+    }
+    return {name: limit for name, limit in thresholds.items() if limit is not None}
+
+
+class _CsvWriter:
+    """Writes rows to a CSV file, `columns` maps the column names to "time", "int" or "float"."""
+
+    def __init__(self, path, columns):
+        self._file = open(path, "w", newline="")
+        self._writer = csv.DictWriter(self._file, fieldnames=list(columns))
+        self._writer.writeheader()
+
+    def write_rows(self, rows):
+        self._writer.writerows(rows)
+        self._file.flush()
+
+    def flush(self):
+        # rows are flushed as they're written
+        pass
+
+    def close(self):
+        self._file.close()
+
+
+class _ParquetWriter:
+    # rows per row group, a row per window would make the file mostly metadata
+    ROW_GROUP_SIZE = 60
+
+    def __init__(self, path, columns):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError as e:
+            raise ValueError("pyarrow is required for writing .parquet files") from e
+        self._pyarrow = pyarrow
+        types = {
+            "time": pyarrow.timestamp("ms"),
+            "int": pyarrow.int64(),
+            "float": pyarrow.float64(),
+        }
+        self._schema = pyarrow.schema(
+            [(name, types[kind]) for name, kind in columns.items()]
+        )
+        self._writer = pyarrow.parquet.ParquetWriter(path, self._schema)
+        self._rows = []
+
+    def write_rows(self, rows):
+        self._rows.extend(rows)
+        if len(self._rows) >= self.ROW_GROUP_SIZE:
+            self._write_row_group()
+
+    def flush(self):
+        self._write_row_group()
+
+    def _write_row_group(self):
+        if self._rows:
+            self._writer.write_table(
+                self._pyarrow.Table.from_pylist(self._rows, schema=self._schema)
+            )
+            self._rows = []
+
+    def close(self):
+        self._write_row_group()
+        self._writer.close()
+
+
+class TimeSeries:
+    """Aggregates the request metrics into fixed time windows and writes them out as the test runs.
+
+    Samples go to the window of the time they are recorded at. Windows are written
+    by a background greenlet a couple of seconds after they end, windows without
+    any requests are written too so that stalls show up. The output is CSV, or
+    Parquet if the file name ends with .parquet (needs pyarrow).
+
+    The output file stays open across test runs of the process (e.g. restarts from
+    the web UI), so later runs append to it, and is closed when Locust quits.
+    """
+
+    _instance = None
+    _output = None
+
+    # metric -> column prefix of its percentiles
+    HISTOGRAMS = {
+        "time_to_first_token": "ttft",
+        "inter_token_latency": "itl",
+        "total_latency": "total_latency",
+    }
+    PERCENTILES = [50, 90, 99]
+    # how long after its end a window is written, late samples are still counted
+    FLUSH_DELAY = 2
+
+    def __init__(self, path, interval, slo=False):
+        self.path = path
+        self.interval = interval
+        self.slo = slo
+        self.columns = {
+            "time": "time",
+            "requests": "int",
+            "failures": "int",
+            "qps": "float",
+            "tokens_per_s": "float",
+        }
+        for prefix in self.HISTOGRAMS.values():
+            for p in self.PERCENTILES:
+                self.columns[f"{prefix}_p{p}"] = "float"
+        if slo:
+            self.columns["slo_attainment"] = "float"
+            self.columns["goodput"] = "float"
+            self.columns["goodput_tokens_per_s"] = "float"
+        self._windows = {}
+        self._next_window = None
+        self._flusher = gevent.spawn(self._flush_periodically)
+
+    @classmethod
+    def start(cls, path, interval, slo=False):
+        if cls._instance is None:
+            cls._instance = cls(path, interval, slo)
+        return cls._instance
+
+    def _window(self):
+        key = int(time.time() // self.interval)
+        window = self._windows.get(key)
+        if window is None:
+            window = self._windows[key] = {"failures": 0, "histograms": {}}
+            if self._next_window is None:
+                self._next_window = key
+        return window
+
+    def record(self, name, value):
+        if name in self.HISTOGRAMS or name in ("num_tokens", "slo_met", "goodput_tokens"):
+            histograms = self._window()["histograms"]
+            histogram = histograms.get(name)
+            if histogram is None:
+                histogram = histograms[name] = HdrHistogram()
+            histogram.record(value)
+
+    def record_failure(self):
+        self._window()["failures"] += 1
+
+    def _row(self, key, window):
+        histograms = window["histograms"]
+        requests = histograms["total_latency"].count if "total_latency" in histograms else 0
+        tokens = histograms["num_tokens"].sum if "num_tokens" in histograms else 0
+        row = {
+            "time": datetime.datetime.fromtimestamp(key * self.interval),
+            "requests": requests,
+            "failures": window["failures"],
+            "qps": requests / self.interval,
+            "tokens_per_s": tokens / self.interval,
+        }
+        for name, prefix in self.HISTOGRAMS.items():
+            histogram = histograms.get(name)
+            for p in self.PERCENTILES:
+                row[f"{prefix}_p{p}"] = (
+                    round(histogram.percentile(p / 100), 3) if histogram else None
+                )
+        if self.slo:
+            slo_met = histograms.get("slo_met")
+            goodput_tokens = histograms.get("goodput_tokens")
+            row["slo_attainment"] = (
+                round(slo_met.sum / slo_met.count * 100, 3) if slo_met else None
+            )
+            row["goodput"] = (slo_met.sum if slo_met else 0) / self.interval
+            row["goodput_tokens_per_s"] = (
+                goodput_tokens.sum if goodput_tokens else 0
+            ) / self.interval
+        return row
+
+    def flush(self, final=False):
+        if self._next_window is None:
+            return
+        if final:
+            # up to now, so the empty windows of a stall at the end are written too
+            last = max([int(time.time() // self.interval), *self._windows])
+        else:
+            last = int((time.time() - self.FLUSH_DELAY) // self.interval) - 1
+        rows = []
+        while self._next_window <= last:
+            window = self._windows.pop(
+                self._next_window, {"failures": 0, "histograms": {}}
+            )
+            rows.append(self._row(self._next_window, window))
+            self._next_window += 1
+        if not rows:
+            return
+        if TimeSeries._output is None:
+            path = _worker_output_path(self.path)
+            if path.endswith(".parquet"):
+                TimeSeries._output = _ParquetWriter(path, self.columns)
+            else:
+                TimeSeries._output = _CsvWriter(path, self.columns)
+        TimeSeries._output.write_rows(rows)
+
+    def _flush_periodically(self):
+        while True:
+            gevent.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"WARNING: failed to write the time series to {self.path}: {repr(e)}")
+
+    def close(self):
+        self._flusher.kill()
+        self.flush(final=True)
+        if TimeSeries._output is not None:
+            TimeSeries._output.flush()
+
+    @classmethod
+    def close_output(cls):
+        if cls._output is not None:
+            cls._output.close()
+            cls._output = None
+
+
+class RequestLog:
+    """Writes a JSONL record for every request, completed or failed, for offline analysis.
+
+    Records are buffered and written by a background greenlet once per
+    REQUEST_LOG_FLUSH_INTERVAL, the file write itself runs on the hub's thread
+    pool. Token counts that are computed by the TokenCounter are filled into the
+    record when they are ready before it's written.
+    """
+
+    _instance = None
+
+    def __init__(self, path):
+        self.path = path
+        self._records = []
+        self._file = None
+        self._flusher = gevent.spawn(self._flush_periodically)
+
+    @classmethod
+    def start(cls, path):
+        if cls._instance is None:
+            cls._instance = cls(path)
+        return cls._instance
+
+    def add(self, record):
+        self._records.append(record)
+
+    def flush(self):
+        if not self._records:
+            return
+        records, self._records = self._records, []
+        data = b"".join(orjson.dumps(r, option=orjson.OPT_APPEND_NEWLINE) for r in records)
+        if self._file is None:
+            self._file = open(_worker_output_path(self.path), "ab")
+        gevent.get_hub().threadpool.apply(self._write, (data,))
+
+    def _write(self, data):
+        self._file.write(data)
+        self._file.flush()
+
+    def _flush_periodically(self):
+        while True:
+            gevent.sleep(REQUEST_LOG_FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"WARNING: failed to write the request log to {self.path}: {repr(e)}")
+
+    def close(self):
+        self._flusher.kill()
+        self.flush()
+        if self._file is not None:
+            self._file.close()
 
 
 PROMPT_CHAT_IMAGE_PLACEHOLDER = "<image>"
 
+# Requests dispatched later than this after their scheduled time are counted as late,
+# smaller delays are within the jitter of the gevent loop (a few ms at p99 even
+# when the client keeps up)
+LATE_DISPATCH_THRESHOLD_MS = 10
+
+# Texts tokenized per call by the TokenCounter, and the longest a text waits
+# in the queue for a batch to fill up
+TOKEN_COUNT_BATCH_SIZE = 64
+TOKEN_COUNT_MAX_DELAY = 0.05
+# Number of prompt token counts kept in the TokenCounter cache
+TOKEN_COUNT_CACHE_SIZE = 100000
+
+# How often buffered --request-log records are written out, in seconds
+REQUEST_LOG_FLUSH_INTERVAL = 1
+
+# Max number of keep-alive connections kept per host in --open-loop mode, the
+# default of 10 would make requests reconnect as soon as more are in flight
+OPEN_LOOP_POOL_SIZE = 1000
+
+
+def _tokenizer_fingerprint(tokenizer_path: str):
+    """Identifies a tokenizer without loading it.
+
+    For a local directory that's its path plus the size and mtime of the tokenizer
+    files, for a hub model just its name.
+    """
+    parts = [tokenizer_path]
+    if os.path.isdir(tokenizer_path):
+        for name in sorted(os.listdir(tokenizer_path)):
+            if name.startswith(
+                ("tokenizer", "vocab", "merges", "special_tokens", "added_tokens")
+            ) or name.endswith(".model"):
+                st = os.stat(os.path.join(tokenizer_path, name))
+                parts.append(f"{name}:{st.st_size}:{st.st_mtime_ns}")
+    return "|".join(parts)
+
 
 class LimericsDataset:
+    """Synthesizes prompts of a target token length from the limericks corpus.
+
+    The corpus is tokenized once as a whole and kept as a flat token id buffer with
+    the character offset of every token. A prompt body of N tokens is the text
+    between the offsets of tokens `i` and `i + N` for a random `i`, so sampling is
+    O(1) and needs no tokenizer. The prefix, body and suffix are joined as text and
+    not retokenized, tokens merging across the joins can make a prompt a token or
+    two off the target.
+    """
+
     _PROMPT = "\n\nTranslate the limericks above to Spanish, then re-write limericks using different styles. Do it 10 times."
+    _CACHE_VERSION = 3
+    _CACHE_HEADER_LEN = struct.Struct("<I")
 
     def __init__(
         self,
@@ -52,65 +542,321 @@ class LimericsDataset:
         chat: bool,
         num_tokens: int,
         common_tokens: int,
+        cache_dir: Optional[str] = None,
     ):
-        self._tokenizer = transformers.AutoTokenizer.from_pretrained(tokenizer_path)
         self._num_tokens = num_tokens
+        self._tokenizer_path = tokenizer_path
+        self._tokenizer = None
 
-        self._all_limericks = []
         with open(path, "r") as f:
-            text = f.read()
-            lims = text.split("\n\n")
-            for i, lim in enumerate(lims):
-                num_tokens = len(self._tokenizer.encode(lim))
-                self._all_limericks.append((lim, num_tokens))
-
-        self._prefix = ""
+            self._text = f.read()
+
+        cache_path = None
+        if cache_dir:
+            key = hashlib.sha256(
+                "\0".join(
+                    [
+                        str(self._CACHE_VERSION),
+                        self._text,
+                        self._PROMPT,
+                        _tokenizer_fingerprint(tokenizer_path),
+                    ]
+                ).encode()
+            ).hexdigest()
+            cache_path = os.path.join(cache_dir, f"limericks-{key[:32]}.bin")
+        cached = self._load_token_cache(cache_path) if cache_path else None
+        if cached is None:
+            cached = self._tokenize()
+            if cache_path:
+                self._save_token_cache(cache_path, *cached)
+        meta, self._token_ids, self._token_starts = cached
+
+        # the prefix shared by all requests is a fixed slice of the corpus
+        suffix_tokens = meta["suffix_tokens"]
+        prefix_tokens = max(0, common_tokens - suffix_tokens)
+        self._prefix = self._token_slice(
+            random.randrange(len(self._token_ids)), prefix_tokens
+        )
         self._suffix = self._PROMPT
-        self._prefix_suffix_tokens = len(self._tokenizer.encode(self._PROMPT))
-        while self._prefix_suffix_tokens < common_tokens:
-            lim, num_tokens = self._all_limericks[
-                random.randint(0, len(self._all_limericks) - 1)
-            ]
-            self._prefix += lim + "\n\n"
-            self._prefix_suffix_tokens += num_tokens
+        self._prefix_suffix_tokens = prefix_tokens + suffix_tokens
 
         if chat:
-            empty_tempalate_tokens = self._tokenizer.apply_chat_template(
-                [{"role": "user", "content": ""}],
-                tokenize=True,
-                add_generation_prompt=True,
+            if meta["chat_template_tokens"] is None:
+                raise ValueError(f"Tokenizer {tokenizer_path} has no chat template")
+            self._prefix_suffix_tokens += meta["chat_template_tokens"]
+        else:
+            # e.g. BOS added by the server
+            self._prefix_suffix_tokens += meta["special_tokens"]
+
+    def _get_tokenizer(self):
+        if self._tokenizer is None:
+            self._tokenizer = InitTracker.load_tokenizer(self._tokenizer_path)
+        return self._tokenizer
+
+    def _tokenize(self):
+        """Tokenizes the whole corpus, returns `(meta, token_ids, token_starts)`.
+
+        `token_starts` holds the character offset of every token, it's left empty for
+        tokenizers that can't report offsets and slices are decoded instead.
+        """
+        tokenizer = self._get_tokenizer()
+        try:
+            encoded = tokenizer(
+                self._text, add_special_tokens=False, return_offsets_mapping=True
+            )
+            token_starts = array("I", (start for start, _ in encoded["offset_mapping"]))
+        except NotImplementedError:
+            # only fast tokenizers support offsets
+            encoded = tokenizer(self._text, add_special_tokens=False)
+            token_starts = array("I")
+        token_ids = array("I", encoded["input_ids"])
+        try:
+            chat_template_tokens = len(
+                tokenizer.apply_chat_template(
+                    [{"role": "user", "content": ""}],
+                    tokenize=True,
+                    add_generation_prompt=True,
+                )
             )
-            self._prefix_suffix_tokens += len(empty_tempalate_tokens)
+        except Exception:
+            chat_template_tokens = None
+        # the shared tokenizer has add_bos_token switched off, so the special
+        # tokens the server adds are counted with a fresh one
+        import transformers
+
+        server_tokenizer = transformers.AutoTokenizer.from_pretrained(
+            self._tokenizer_path
+        )
+        meta = {
+            "suffix_tokens": len(
+                tokenizer.encode(self._PROMPT, add_special_tokens=False)
+            ),
+            "special_tokens": len(server_tokenizer.encode("")),
+            "chat_template_tokens": chat_template_tokens,
+        }
+        return meta, token_ids, token_starts
+
+    @classmethod
+    def _load_token_cache(cls, cache_path):
+        try:
+            with open(cache_path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        (header_len,) = cls._CACHE_HEADER_LEN.unpack_from(data)
+        pos = cls._CACHE_HEADER_LEN.size
+        meta = json.loads(data[pos : pos + header_len])
+        pos += header_len
+        token_ids = array("I")
+        ids_end = pos + meta["num_tokens"] * token_ids.itemsize
+        token_ids.frombytes(data[pos:ids_end])
+        token_starts = array("I")
+        token_starts.frombytes(data[ids_end:])
+        return meta, token_ids, token_starts
+
+    @classmethod
+    def _save_token_cache(cls, cache_path, meta, token_ids, token_starts):
+        header = json.dumps(dict(meta, num_tokens=len(token_ids))).encode()
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(cls._CACHE_HEADER_LEN.pack(len(header)))
+                f.write(header)
+                token_ids.tofile(f)
+                token_starts.tofile(f)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            print(f"WARNING: can't write tokenization cache {cache_path}: {e}")
+
+    def _token_slice(self, start, num_tokens):
+        """Text of `num_tokens` consecutive corpus tokens from `start`, wrapping around."""
+        total = len(self._token_ids)
+        parts = []
+        while num_tokens > 0:
+            end = min(total, start + num_tokens)
+            if self._token_starts:
+                stop = self._token_starts[end] if end < total else len(self._text)
+                parts.append(self._text[self._token_starts[start] : stop])
+            else:
+                parts.append(self._get_tokenizer().decode(self._token_ids[start:end]))
+            num_tokens -= end - start
+            start = 0
+        return "".join(parts)
 
     def __next__(self):
-        prompt_tokens = self._prefix_suffix_tokens
-        prompt = self._prefix
-        while prompt_tokens < self._num_tokens:
-            lim, num_tokens = self._all_limericks[
-                random.randint(0, len(self._all_limericks) - 1)
-            ]
+        return self.sample(self._num_tokens)
 
-            prompt += lim + "\n\n"
-            prompt_tokens += num_tokens
-        prompt += self._suffix
+    def random_slice(self, num_tokens):
+        """Text of `num_tokens` tokens from a random position of the corpus."""
+        return self._token_slice(random.randrange(len(self._token_ids)), num_tokens)
 
-        return prompt, prompt_tokens
+    def sample(self, num_tokens, prefix="", prefix_tokens=0):
+        """Builds a prompt of `num_tokens` tokens (or just prefix and suffix if they're longer).
+
+        `prefix` of `prefix_tokens` tokens is inserted after the common prefix.
+        """
+        fixed_tokens = self._prefix_suffix_tokens + prefix_tokens
+        body_tokens = max(0, num_tokens - fixed_tokens)
+        prompt = self._prefix + prefix + self.random_slice(body_tokens) + self._suffix
+        return prompt, fixed_tokens + body_tokens
 
     def __iter__(self):
         return self
 
 
+class PrefixCacheWorkload:
+    """Limerics prompts sharing one of K prefixes, to exercise server-side prefix caching.
+
+    A `hit_ratio` share of the requests starts with one of the shared prefixes, picked
+    with Zipf popularity (`zipf=0` is uniform), the rest get a unique prefix of the same
+    length. Each prefix takes `fraction` of the prompt tokens.
+    """
+
+    _instance = None
+
+    def __init__(self, dataset, num_tokens, groups, fraction, hit_ratio, zipf):
+        if not isinstance(dataset, LimericsDataset):
+            raise ValueError("--prefix-groups requires the limerics dataset")
+        self.dataset = dataset
+        self.hit_ratio = hit_ratio
+        self.prefix_tokens = int(num_tokens * fraction)
+        self.prefixes = [dataset.random_slice(self.prefix_tokens) for _ in range(groups)]
+        self.cum_weights = list(
+            itertools.accumulate(1 / (rank + 1) ** zipf for rank in range(groups))
+        )
+
+    @classmethod
+    def get_instance(cls, dataset, options: argparse.Namespace):
+        if cls._instance is None:
+            cls._instance = cls(
+                dataset,
+                options.prompt_tokens,
+                options.prefix_groups,
+                options.prefix_fraction,
+                options.prefix_hit_ratio,
+                options.prefix_zipf,
+            )
+        return cls._instance
+
+    def sample(self, num_tokens):
+        """Returns `(prompt, prompt_tokens, prefix_group)` with group `prefix_<i>` or `prefix_miss`."""
+        if random.random() < self.hit_ratio:
+            group = random.choices(
+                range(len(self.prefixes)), cum_weights=self.cum_weights
+            )[0]
+            prefix = self.prefixes[group]
+            prefix_group = f"prefix_{group}"
+        else:
+            prefix = self.dataset.random_slice(self.prefix_tokens)
+            prefix_group = "prefix_miss"
+        prompt, prompt_tokens = self.dataset.sample(
+            num_tokens, prefix, self.prefix_tokens
+        )
+        return prompt, prompt_tokens, prefix_group
+
+
 class JsonlDataset:
-    def __init__(self, path: str):
+    """Requests read on demand from a memory-mapped JSONL file.
+
+    The offsets of all lines are indexed once and the index is cached next to the
+    file (`<path>.idx`), so only the lines actually sent are parsed and the file
+    doesn't need to fit in memory. All users share one sampler:
+
+    - sequential: file order, looping
+    - random: uniform sampling with replacement
+    - shuffle: random order without replacement, reshuffled on every pass
+    - shard: file order, every worker only takes its own share of the lines
+    """
+
+    _INDEX_MAGIC = b"JSONLIDX"
+    _INDEX_HEADER = struct.Struct("<8sQQQ")
+
+    def __init__(self, path: str, sampling: str = "sequential"):
         self.path = path
+        self.sampling = sampling
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._offsets = self._load_index()
+        if not len(self._offsets):
+            raise ValueError(f"Dataset {path} is empty")
+
+        if sampling == "shard":
+            self._lines = range(
+                InitTracker.worker_index, len(self._offsets), InitTracker.worker_count
+            )
+        else:
+            self._lines = range(len(self._offsets))
+        if sampling == "shuffle":
+            self._order = array("Q", self._lines)
+        elif sampling not in ("sequential", "random", "shard"):
+            raise ValueError(f"Unknown dataset sampling {sampling}")
+        self._cursor = 0
+
+    def _load_index(self):
+        st = os.stat(self.path)
+        index_path = self.path + ".idx"
+        try:
+            with open(index_path, "rb") as f:
+                index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, size, mtime_ns, count = self._INDEX_HEADER.unpack_from(index)
+            if magic == self._INDEX_MAGIC and (size, mtime_ns) == (
+                st.st_size,
+                st.st_mtime_ns,
+            ):
+                return memoryview(index)[self._INDEX_HEADER.size :].cast("Q")
+        except (OSError, ValueError, struct.error):
+            pass
+
+        print(f"Indexing {self.path}")
+        offsets = array("Q")
+        mm = self._mmap
+        pos = 0
+        while pos < len(mm):
+            end = mm.find(b"\n", pos)
+            if end < 0:
+                end = len(mm)
+            # skip blank lines without copying out every line
+            if end - pos > 2 or mm[pos:end].strip():
+                offsets.append(pos)
+            pos = end + 1
+        try:
+            tmp_path = f"{index_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(
+                    self._INDEX_HEADER.pack(
+                        self._INDEX_MAGIC, st.st_size, st.st_mtime_ns, len(offsets)
+                    )
+                )
+                offsets.tofile(f)
+            os.replace(tmp_path, index_path)
+        except OSError as e:
+            print(f"WARNING: can't write dataset index {index_path}: {e}")
+        return offsets
+
+    def _next_line(self):
+        if self.sampling == "random":
+            return random.choice(self._lines)
+        if self._cursor == len(self._lines):
+            self._cursor = 0
+        if self.sampling == "shuffle":
+            if self._cursor == 0:
+                random.shuffle(self._order)
+            line = self._order[self._cursor]
+        else:
+            line = self._lines[self._cursor]
+        self._cursor += 1
+        return line
 
     def __iter__(self):
-        return itertools.cycle(self._read_data())
+        return self
 
-    def _read_data(self):
-        with open(self.path, "r") as f:
-            for line in f:
-                yield json.loads(line), 0
+    def __next__(self):
+        start = self._offsets[self._next_line()]
+        end = self._mmap.find(b"\n", start)
+        if end < 0:
+            end = len(self._mmap)
+        return orjson.loads(self._mmap[start:end]), 0
 
 
 class DatasetHolder:
@@ -119,7 +865,7 @@ class DatasetHolder:
     @classmethod
     def _create_dataset(cls, options: argparse.Namespace):
         if options.dataset.startswith("@"):
-            return JsonlDataset(options.dataset[1:])
+            return JsonlDataset(options.dataset[1:], options.dataset_sampling)
         elif options.dataset == "limerics":
             assert (
                 options.tokenizer is not None
@@ -132,6 +878,7 @@ class DatasetHolder:
                 chat=options.chat,
                 num_tokens=options.prompt_tokens,
                 common_tokens=options.prompt_cache_max_len,
+                cache_dir=options.cache_dir,
             )
         else:
             raise ValueError(f"Unknown dataset: {options.dataset}")
@@ -143,18 +890,158 @@ class DatasetHolder:
         return cls._instance
 
 
-class FixedQPSPacer:
+@dataclass
+class PreparedRequest:
+    body: bytes
+    max_tokens: int
+    prompt_tokens: int
+    prefix_group: Optional[str] = None
+    turn: Optional[int] = None  # 1-based turn of a multi-turn chat session
+    probe: bool = False  # part of the --probe-qps stream
+
+
+class RequestPlan:
+    """Request bodies serialized ahead of the run into a memory-mapped file.
+
+    Layout: magic, length-prefixed JSON header, a fixed-size index record per request
+    (offset, length, max_tokens, prompt_tokens) and the concatenated bodies. Replaying
+    a request copies its body out of the mapping, nothing is built or encoded, and
+    the same file replays the exact same bytes on any machine.
+    """
+
+    MAGIC = b"LLMPLAN1"
+    _HEADER_LEN = struct.Struct("<I")
+    _RECORD = struct.Struct("<QIII")
+
+    _instance = None
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[: len(self.MAGIC)] != self.MAGIC:
+            raise ValueError(f"{path} is not a request plan file")
+        pos = len(self.MAGIC)
+        (header_len,) = self._HEADER_LEN.unpack_from(self._mmap, pos)
+        pos += self._HEADER_LEN.size
+        self.metadata = json.loads(self._mmap[pos : pos + header_len])
+        self._index_pos = pos + header_len
+        self._size = self.metadata["num_requests"]
+        self._cursor = itertools.count()
+
+    @classmethod
+    def compile(cls, path: str, metadata: dict, prepare_request, num_requests: int):
+        """Generates `num_requests` requests with `prepare_request()` and writes them to `path`."""
+        metadata = dict(metadata, num_requests=num_requests)
+        header = json.dumps(metadata).encode()
+        index_pos = len(cls.MAGIC) + cls._HEADER_LEN.size + len(header)
+        offset = index_pos + cls._RECORD.size * num_requests
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(cls.MAGIC)
+            f.write(cls._HEADER_LEN.pack(len(header)))
+            f.write(header)
+            index = bytearray(cls._RECORD.size * num_requests)
+            f.write(index)
+            for i in range(num_requests):
+                request = prepare_request()
+                cls._RECORD.pack_into(
+                    index,
+                    i * cls._RECORD.size,
+                    offset,
+                    len(request.body),
+                    request.max_tokens,
+                    request.prompt_tokens or 0,
+                )
+                f.write(request.body)
+                offset += len(request.body)
+            f.seek(index_pos)
+            f.write(index)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def get_instance(cls, options: argparse.Namespace, metadata: dict, prepare_request):
+        if cls._instance is None:
+            path = options.request_plan
+            if not os.path.exists(path):
+                if isinstance(InitTracker.environment.runner, WorkerRunner):
+                    # workers would each compile a different random plan at the
+                    # same time, and their interleaved replay needs the same one
+                    raise ValueError(
+                        f"Request plan {path} doesn't exist, compile it with a local run first and copy it to every worker"
+                    )
+                print(f"Compiling {options.request_plan_size} requests into {path}")
+                cls.compile(path, metadata, prepare_request, options.request_plan_size)
+            cls._instance = cls(path)
+            print(f"Replaying {len(cls._instance)} requests from {path}")
+            # the bodies bake in all of these, replaying them under other
+            # settings would fail or silently send something else
+            compiled = cls._instance.metadata
+            for key in (set(compiled) | set(metadata)) - {"num_requests"}:
+                if compiled.get(key) != metadata.get(key):
+                    raise ValueError(
+                        f"Request plan {path} was compiled for {key}={compiled.get(key)}, not {metadata.get(key)}"
+                    )
+        return cls._instance
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, i):
+        offset, length, max_tokens, prompt_tokens = self._RECORD.unpack_from(
+            self._mmap, self._index_pos + i * self._RECORD.size
+        )
+        return PreparedRequest(
+            body=self._mmap[offset : offset + length],
+            max_tokens=max_tokens,
+            prompt_tokens=prompt_tokens,
+        )
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        # shared by all users, so together they replay the plan in order; in
+        # distributed mode every worker replays its own interleaved slice
+        i = next(self._cursor) * InitTracker.worker_count + InitTracker.worker_index
+        return self[i % self._size]
+
+
+class ArrivalPacer(abc.ABC):
+    """Produces the schedule of send times shared by all users of the process."""
+
+    @abc.abstractmethod
+    def next_arrival(self):
+        """Returns `(send_time, trace_record)` for the next request, or None once the schedule is over."""
+
+    def wait_time_till(self, t):
+        now = time.time()
+        if now > t:
+            print(
+                f"WARNING: not enough locust users to keep up with the desired QPS. Either the number of locust users is too low or the server is overloaded. Delay: {now-t:.3f}s"
+            )
+            return 0
+        return t - now
+
+
+class FixedQPSPacer(ArrivalPacer):
     _instance = None
 
     def __init__(self, qps, distribution):
         self.qps = qps
         self.distribution = distribution
+        self._restart = False
 
         # It's kind of thread safe thanks to GIL as the only state is `t` - good enough for a loadtest
         def gen():
-            t = time.time()
-            mean_wait = 1 / self.qps
+            t = None
             while True:
+                if t is None or self._restart:
+                    # in distributed mode every worker takes its share of the rate, with
+                    # the constant schedules of the workers shifted against each other
+                    self._restart = False
+                    t = time.time() + InitTracker.worker_index / self.qps
+                mean_wait = InitTracker.worker_count / self.qps
                 if self.distribution == "exponential":
                     wait = random.expovariate(1 / mean_wait)
                 elif self.distribution == "uniform":
@@ -178,15 +1065,186 @@ class FixedQPSPacer:
             assert cls._instance.distribution == distribution
         return cls._instance
 
-    def wait_time_till_next(self):
-        t = next(self.iterator)
-        now = time.time()
-        if now > t:
-            print(
-                f"WARNING: not enough locust users to keep up with the desired QPS. Either the number of locust users is too low or the server is overloaded. Delay: {now-t:.3f}s"
+    def next_arrival(self):
+        return next(self.iterator), None
+
+    def set_qps(self, qps):
+        """Changes the rate of a running test, the schedule restarts from now."""
+        self.qps = qps
+        self._restart = True
+
+
+@dataclass
+class TraceRecord:
+    timestamp: float  # seconds since the first request of the trace
+    input_length: int
+    output_length: int
+
+
+def load_trace(path: str):
+    """Loads request arrivals from a production trace.
+
+    Either a CSV in the Azure LLM inference trace format (`TIMESTAMP,ContextTokens,GeneratedTokens`)
+    or a JSONL file with `timestamp` (seconds), `input_length` and `output_length` fields.
+    """
+    records = []
+    if path.endswith(".csv"):
+        with open(path, "r", newline="") as f:
+            for row in csv.DictReader(f):
+                # the trace has 100ns precision that datetime can't parse
+                ts, _, fraction = row["TIMESTAMP"].strip().partition(".")
+                ts = datetime.datetime.strptime(
+                    f"{ts}.{fraction[:6] or 0}", "%Y-%m-%d %H:%M:%S.%f"
+                )
+                records.append(
+                    TraceRecord(
+                        timestamp=ts.timestamp(),
+                        input_length=int(row["ContextTokens"]),
+                        output_length=int(row["GeneratedTokens"]),
+                    )
+                )
+    else:
+        with open(path, "r") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                records.append(
+                    TraceRecord(
+                        timestamp=float(record["timestamp"]),
+                        input_length=int(record["input_length"]),
+                        output_length=int(record["output_length"]),
+                    )
+                )
+    if not records:
+        raise ValueError(f"Trace {path} is empty")
+    records.sort(key=lambda r: r.timestamp)
+    start = records[0].timestamp
+    for record in records:
+        record.timestamp -= start
+    return records
+
+
+class TraceReplayPacer(ArrivalPacer):
+    """Dispatches requests at the arrival times recorded in a trace."""
+
+    _instance = None
+    finished_users = 0
+
+    def __init__(self, path, speedup):
+        self.path = path
+        self.speedup = speedup
+        records = load_trace(path)
+        # in distributed mode every worker replays every N-th request
+        self.records = records[InitTracker.worker_index :: InitTracker.worker_count]
+        print(
+            f"Replaying {len(self.records)} requests over {records[-1].timestamp / speedup:.1f}s from {path}"
+        )
+
+        def gen():
+            start = time.time()
+            for record in self.records:
+                yield start + record.timestamp / self.speedup, record
+
+        self.iterator = gen()
+
+    @classmethod
+    def instance(cls, path, speedup):
+        if cls._instance is None:
+            cls._instance = cls(path, speedup)
+        return cls._instance
+
+    def next_arrival(self):
+        return next(self.iterator, None)
+
+    @classmethod
+    def notify_user_finished(cls, environment):
+        """Stops the test once every user of the process ran out of trace."""
+        cls.finished_users += 1
+        # the target is known before spawning completes, users may run out of
+        # trace while the others are still being spawned
+        if cls.finished_users < environment.runner.target_user_count:
+            return
+        print("Trace replay finished")
+        if isinstance(environment.runner, WorkerRunner):
+            environment.runner.send_message("trace_finished")
+        else:
+            gevent.spawn(environment.runner.quit)
+
+
+# Locust stats name of the --probe-qps requests
+PROBE_REQUEST_NAME = "probe"
+
+
+class ProbeStream:
+    """Low-rate stream of short requests sent alongside the main load (--probe-qps).
+
+    It measures the latency a light request sees under the current load. The
+    probe has its own constant-rate pacer and max_tokens, its requests show up
+    as PROBE_REQUEST_NAME in Locust's stats and its metrics are recorded with a
+    `probe_` prefix, so they stay out of the main metrics, the time series and
+    the SLOs. Requests are dispatched open-loop from one greenlet per process,
+    over the HTTP client of one of the running users.
+    """
+
+    _instance = None
+
+    def __init__(self, qps):
+        self.pacer = FixedQPSPacer(qps, "constant")
+        self.users = []
+        self._next_user = itertools.count()
+        self.in_flight = gevent.pool.Group()
+        self._dispatcher = gevent.spawn(self._dispatch)
+
+    @classmethod
+    def register(cls, user):
+        if cls._instance is None:
+            cls._instance = cls(user.environment.parsed_options.probe_qps)
+        cls._instance.users.append(user)
+
+    @classmethod
+    def unregister(cls, user):
+        if cls._instance is not None and user in cls._instance.users:
+            cls._instance.users.remove(user)
+
+    def _dispatch(self):
+        while True:
+            t, _ = self.pacer.next_arrival()
+            delay = t - time.time()
+            if delay > 0:
+                gevent.sleep(delay)
+            if not self.users:
+                # no users while ramping down, skip this slot
+                continue
+            # spread over the users' sessions and connections
+            user = self.users[next(self._next_user) % len(self.users)]
+            self.in_flight.spawn(
+                user._run_open_loop_request, t, None, user._prepare_probe_request()
             )
-            return 0
-        return t - now
+
+    def stop(self):
+        self._dispatcher.kill(block=False)
+        self.in_flight.kill(block=False)
+
+    @staticmethod
+    def _stats_entry(environment):
+        return environment.stats.entries.get((PROBE_REQUEST_NAME, "POST"))
+
+    @classmethod
+    def num_requests(cls, environment):
+        entry = cls._stats_entry(environment)
+        return entry.num_requests if entry is not None else 0
+
+    @classmethod
+    def num_failures(cls, environment):
+        """Probes marked as failed in Locust's stats: HTTP errors, unparsable or empty responses."""
+        entry = cls._stats_entry(environment)
+        return entry.num_failures if entry is not None else 0
+
+
+def _main_num_failures(environment):
+    """Failed requests of the main load, without the probe's."""
+    return environment.stats.total.num_failures - ProbeStream.num_failures(environment)
 
 
 class LengthSampler:
@@ -253,6 +1311,9 @@ class InitTracker:
     deferred_run_time_seconds = None
     stop_scheduled = False
     stats_reset_done = False
+    # position of this process among the workers in distributed mode
+    worker_index = 0
+    worker_count = 1
 
     @classmethod
     def notify_init(cls, environment, logging_params):
@@ -272,6 +1333,9 @@ class InitTracker:
     @classmethod
     def notify_spawning_complete(cls, user_count):
         cls.users = user_count
+        if isinstance(cls.environment.runner, WorkerRunner):
+            # stats reset and the deferred stop are driven by the master
+            return
         # Start steady-state measurement exactly when all users have spawned
         if not cls.stats_reset_done:
             cls.reset_stats()
@@ -290,10 +1354,32 @@ class InitTracker:
 
     @classmethod
     def reset_stats(cls):
-        assert cls.environment.runner, "only local mode is supported"
+        assert cls.environment.runner, "stats can only be reset on a local or master runner"
         print("Resetting stats after traffic reach a steady state")
         cls.environment.events.reset_stats.fire()
         cls.environment.runner.stats.reset_all()
+        if isinstance(cls.environment.runner, MasterRunner):
+            # drop what the workers have collected but not reported yet
+            cls.environment.runner.send_message("reset_custom_metrics")
+
+    @classmethod
+    def set_qps(cls, qps):
+        """Changes the target QPS of the running test, on the workers too."""
+        cls.apply_qps(qps)
+        if isinstance(cls.environment.runner, MasterRunner):
+            cls.environment.runner.send_message("set_qps", qps)
+
+    @classmethod
+    def apply_qps(cls, qps):
+        # users spawned later create the pacer from the options
+        cls.environment.parsed_options.qps = qps
+        if FixedQPSPacer._instance is not None:
+            FixedQPSPacer._instance.set_qps(qps)
+
+    @classmethod
+    def notify_shard(cls, index, count):
+        cls.worker_index = index
+        cls.worker_count = count
 
     @classmethod
     def load_tokenizer(cls, dir):
@@ -312,6 +1398,264 @@ class InitTracker:
 events.spawning_complete.add_listener(InitTracker.notify_spawning_complete)
 
 
+def _prompt_text(payload):
+    """Extracts the text the model is prompted with from a request body."""
+    if "messages" in payload:
+        parts = []
+        for message in payload["messages"]:
+            content = message.get("content")
+            if isinstance(content, str):
+                parts.append(content)
+            elif isinstance(content, list):
+                parts.extend(
+                    part["text"] for part in content if part.get("type") == "text"
+                )
+        return "\n".join(parts)
+    for key in ("prompt", "input", "inputs"):
+        if key in payload:
+            value = payload[key]
+            if isinstance(value, list):
+                return "\n".join(v for v in value if isinstance(v, str))
+            return value if isinstance(value, str) else ""
+    return ""
+
+
+class TokenCounter:
+    """Counts prompt and completion tokens with --tokenizer on an OS thread.
+
+    Requests queue their texts together with a callback and don't wait for the
+    result. Queued texts are tokenized in batches on a separate thread so the
+    greenlets sending requests aren't blocked while the tokenizer runs, the
+    callbacks run back on the event loop. A single thread is used because HF
+    fast tokenizers can't be called concurrently, they parallelize batches
+    internally. Prompt counts are cached, prompts repeat in request plans and
+    JSONL datasets.
+
+    Prompts are counted without the chat template, so for chat requests the
+    count is the number of tokens of the message contents.
+    """
+
+    _instance = None
+
+    def __init__(self, tokenizer):
+        self._tokenizer = tokenizer
+        self._pool = gevent.threadpool.ThreadPool(1)
+        # (request body or None, completion text or None, callback)
+        self._queue = []
+        self._cache = {}
+        self._pending = 0
+        self._flusher = gevent.spawn(self._flush_periodically)
+
+    @classmethod
+    def get_instance(cls, tokenizer_path):
+        if cls._instance is None:
+            cls._instance = cls(InitTracker.load_tokenizer(tokenizer_path))
+        return cls._instance
+
+    def count_prompt(self, body, callback):
+        """Calls `callback` with the number of prompt tokens of the request `body`."""
+        # a digest rather than hash(), a collision would return a wrong count
+        key = hashlib.blake2b(body, digest_size=16).digest()
+        if key in self._cache:
+            callback(self._cache[key])
+            return
+
+        def cache_and_call(n):
+            if len(self._cache) >= TOKEN_COUNT_CACHE_SIZE:
+                # dicts keep insertion order, drop the oldest entry
+                del self._cache[next(iter(self._cache))]
+            self._cache[key] = n
+            callback(n)
+
+        self._enqueue((body, None, cache_and_call))
+
+    def count_completion(self, text, callback):
+        """Calls `callback` with the number of tokens of the generated `text`."""
+        self._enqueue((None, text, callback))
+
+    def _enqueue(self, item):
+        self._queue.append(item)
+        self._pending += 1
+        if len(self._queue) >= TOKEN_COUNT_BATCH_SIZE:
+            self._flush()
+
+    def _flush_periodically(self):
+        while True:
+            gevent.sleep(TOKEN_COUNT_MAX_DELAY)
+            self._flush()
+
+    def _flush(self):
+        if not self._queue:
+            return
+        batch, self._queue = self._queue, []
+        result = self._pool.spawn(self._count, [(body, text) for body, text, _ in batch])
+        gevent.spawn(self._deliver, batch, result)
+
+    def _count(self, items):
+        # runs on the tokenizer thread, the request bodies are parsed here as well
+        texts = [
+            _prompt_text(orjson.loads(body)) if text is None else text
+            for body, text in items
+        ]
+        encoded = self._tokenizer(texts, add_special_tokens=False)["input_ids"]
+        return [len(ids) for ids in encoded]
+
+    def _deliver(self, batch, result):
+        try:
+            counts = result.get()
+        except Exception as e:
+            print(f"WARNING: failed to count tokens of {len(batch)} texts: {repr(e)}")
+            counts = None
+        for i, (_, _, callback) in enumerate(batch):
+            self._pending -= 1
+            if counts is not None:
+                callback(counts[i])
+
+    def drain(self, timeout=30):
+        """Waits for the queued texts to be counted, so their metrics are recorded."""
+        deadline = time.monotonic() + timeout
+        self._flush()
+        while self._pending > 0 and time.monotonic() < deadline:
+            gevent.sleep(TOKEN_COUNT_MAX_DELAY)
+        if self._pending > 0:
+            print(f"WARNING: {self._pending} token counts still pending, dropped")
+
+
+@events.test_stop.add_listener
+def _drain_token_counter(**_kwargs):
+    # before workers send their last report and before the summary is printed
+    if TokenCounter._instance is not None:
+        TokenCounter._instance.drain()
+
+
+@events.test_start.add_listener
+def _start_timeseries(environment, **_kwargs):
+    if isinstance(environment.runner, MasterRunner):
+        # the samples are recorded on the workers
+        return
+    if environment.parsed_options.timeseries_file:
+        TimeSeries.start(
+            environment.parsed_options.timeseries_file,
+            environment.parsed_options.timeseries_interval,
+            slo=bool(_slo_thresholds(environment.parsed_options)),
+        )
+
+
+@events.test_start.add_listener
+def _start_request_log(environment, **_kwargs):
+    if isinstance(environment.runner, MasterRunner):
+        return
+    if environment.parsed_options.request_log:
+        RequestLog.start(environment.parsed_options.request_log)
+
+
+@events.request.add_listener
+def _record_timeseries_failure(exception, name=None, **_kwargs):
+    if (
+        exception is not None
+        and name != PROBE_REQUEST_NAME
+        and TimeSeries._instance is not None
+    ):
+        TimeSeries._instance.record_failure()
+
+
+@events.test_stop.add_listener
+def _stop_probe_stream(**_kwargs):
+    if ProbeStream._instance is not None:
+        ProbeStream._instance.stop()
+        ProbeStream._instance = None
+
+
+@events.test_stop.add_listener
+def _close_timeseries(**_kwargs):
+    # registered after the token counter is drained, so its counts are included
+    if TimeSeries._instance is not None:
+        TimeSeries._instance.close()
+        TimeSeries._instance = None
+
+
+@events.quitting.add_listener
+def _close_timeseries_output(**_kwargs):
+    TimeSeries.close_output()
+
+
+@events.test_stop.add_listener
+def _close_request_log(**_kwargs):
+    if RequestLog._instance is not None:
+        RequestLog._instance.close()
+        RequestLog._instance = None
+
+
+@events.init.add_listener
+def _setup_distributed(environment, **_kwargs):
+    InitTracker.environment = environment
+    if isinstance(environment.runner, MasterRunner):
+        finished_workers = set()
+
+        def on_trace_finished(environment, msg, **kwargs):
+            finished_workers.add(msg.node_id)
+            if len(finished_workers) >= InitTracker.worker_count:
+                gevent.spawn(environment.runner.quit)
+
+        environment.runner.register_message("trace_finished", on_trace_finished)
+    if isinstance(environment.runner, WorkerRunner):
+
+        def on_assign_shard(environment, msg, **kwargs):
+            InitTracker.notify_shard(msg.data["index"], msg.data["count"])
+
+        def on_reset_custom_metrics(environment, msg, **kwargs):
+            CustomMetrics.reset()
+
+        def on_set_qps(environment, msg, **kwargs):
+            InitTracker.apply_qps(msg.data)
+
+        environment.runner.register_message("assign_shard", on_assign_shard)
+        environment.runner.register_message("set_qps", on_set_qps)
+        environment.runner.register_message(
+            "reset_custom_metrics", on_reset_custom_metrics
+        )
+
+
+@events.test_start.add_listener
+def _assign_worker_shards(environment, **_kwargs):
+    """Give every worker its slice of the QPS schedule and of the request plan."""
+    if not isinstance(environment.runner, MasterRunner):
+        return
+    worker_ids = sorted(
+        worker.id
+        for worker in environment.runner.clients.all
+        if worker.state != STATE_MISSING
+    )
+    InitTracker.worker_count = len(worker_ids)
+    for index, worker_id in enumerate(worker_ids):
+        environment.runner.send_message(
+            "assign_shard", {"index": index, "count": len(worker_ids)}, worker_id
+        )
+
+
+@events.report_to_master.add_listener
+def _report_custom_metrics(client_id, data):
+    # histograms are shipped as deltas, the master merges them
+    histograms = CustomMetrics.histograms
+    CustomMetrics.histograms = {}
+    data["custom_metrics"] = {
+        name: histogram.to_dict() for name, histogram in histograms.items()
+    }
+    if InitTracker.logging_params is not None:
+        data["logging_params"] = InitTracker.logging_params
+
+
+@events.worker_report.add_listener
+def _merge_custom_metrics(client_id, data):
+    if data.get("logging_params") is not None:
+        InitTracker.notify_init(InitTracker.environment, data["logging_params"])
+    metrics = data.get("custom_metrics")
+    if metrics:
+        for name, histogram in metrics.items():
+            CustomMetrics.get(name).merge_dict(histogram)
+        CustomMetrics.last_record_time = time.time()
+
+
 def _parse_run_time_to_seconds(run_time_value):
     """Parse Locust -t/--run-time value into seconds (float). Supports both
     already-parsed numeric values and human strings like '30s', '5m', '1h30m'.
@@ -371,6 +1715,13 @@ def _defer_run_time_to_after_spawn(environment, **_kwargs):
         )
 
 
+@events.init.add_listener
+def _seed_random(environment, **_kwargs):
+    seed = getattr(environment.parsed_options, "seed", None)
+    if seed is not None:
+        random.seed(seed)
+
+
 @dataclass
 class ChunkMetadata:
     text: str
@@ -379,12 +1730,114 @@ class ChunkMetadata:
     prompt_usage_tokens: Optional[int]
 
 
+class TokenTimeline:
+    """Arrival time and token count of every streamed chunk of a single request.
+
+    Kept in flat arrays (16 bytes per chunk) and dropped once the request's
+    metrics are logged. Token count is 0 when the provider doesn't report it.
+    """
+
+    __slots__ = ("times", "tokens")
+
+    def __init__(self):
+        self.times = array("d")
+        self.tokens = array("I")
+
+    def add(self, t, num_tokens):
+        self.times.append(t)
+        self.tokens.append(num_tokens)
+
+    def __len__(self):
+        return len(self.times)
+
+    def inter_token_latencies(self):
+        """Returns the gaps between consecutive chunks in ms."""
+        times = self.times
+        return array("d", ((b - a) * 1000 for a, b in zip(times, times[1:])))
+
+
+class SSEParser:
+    """Incremental parser for a `text/event-stream` response body.
+
+    Network reads are appended to one reusable buffer that is scanned in place
+    through a memoryview, so the only copy made is the payload of each complete
+    event. Accepts both `\n` and `\r\n` framing.
+    """
+
+    _FIELDS = (b"event", b"id", b"retry")
+
+    def __init__(self):
+        self._buf = bytearray()
+        self._data = []
+
+    def feed(self, chunk):
+        """Consumes raw bytes and returns the payloads of the events completed by them."""
+        buf = self._buf
+        buf += chunk
+        events = []
+        pos = 0
+        with memoryview(buf) as view:
+            while True:
+                nl = buf.find(b"\n", pos)
+                if nl < 0:
+                    break
+                end = nl - 1 if nl > pos and buf[nl - 1] == 0x0D else nl
+                self._process_line(view, pos, end, events)
+                pos = nl + 1
+        del buf[:pos]
+        return events
+
+    def close(self):
+        """Flushes an event not terminated by an empty line at the end of the stream."""
+        events = []
+        buf = self._buf
+        if buf:
+            end = len(buf) - 1 if buf[-1] == 0x0D else len(buf)
+            with memoryview(buf) as view:
+                self._process_line(view, 0, end, events)
+            buf.clear()
+        self._process_line(None, 0, 0, events)
+        return events
+
+    def _process_line(self, view, start, end, events):
+        if start == end:
+            # an empty line dispatches the event
+            if self._data:
+                data = self._data
+                events.append(data[0] if len(data) == 1 else b"\n".join(data))
+                self._data = []
+            return
+        buf = self._buf
+        if buf.startswith(b"data:", start):
+            start += 5
+            if start < end and buf[start] == 0x20:
+                start += 1
+            self._data.append(bytes(view[start:end]))
+        elif buf[start] == 0x3A:
+            pass  # comment / keep-alive
+        else:
+            colon = buf.find(b":", start, end)
+            field = bytes(view[start : end if colon < 0 else colon])
+            if field not in self._FIELDS:
+                raise ValueError(
+                    f"Unexpected chunk not starting with 'data': {bytes(view[start:end])}"
+                )
+
+
 class BaseProvider(abc.ABC):
     DEFAULT_MODEL_NAME = None
+    # whether the API can be asked for a final usage chunk when streaming
+    SUPPORTS_STREAM_USAGE = False
 
     def __init__(self, model, parsed_options):
         self.model = model
         self.parsed_options = parsed_options
+        self.stream_usage = (
+            self.SUPPORTS_STREAM_USAGE
+            and parsed_options.stream_usage
+            and parsed_options.stream
+            and not parsed_options.embeddings
+        )
 
     @abc.abstractmethod
     def get_url(self): ...
@@ -395,8 +1848,30 @@ class BaseProvider(abc.ABC):
     @abc.abstractmethod
     def parse_output_json(self, json): ...
 
+    def reports_completion_tokens(self):
+        """Whether responses carry the number of completion tokens (usage or per-token logprobs)."""
+        return self.parsed_options.logprobs is not None
+
+    def is_trailing_chunk(self, data):
+        """Whether `data` is a chunk sent after the last generated token."""
+        return False
+
 
 class OpenAIProvider(BaseProvider):
+    SUPPORTS_STREAM_USAGE = True
+
+    def is_trailing_chunk(self, data):
+        # e.g. the usage chunk requested with stream_options
+        return not data.get("choices")
+
+    def reports_completion_tokens(self):
+        # non-streaming responses always have usage
+        return (
+            self.stream_usage
+            or not self.parsed_options.stream
+            or super().reports_completion_tokens()
+        )
+
     def get_url(self):
         if self.parsed_options.embeddings:
             return "/v1/embeddings"
@@ -429,6 +1904,8 @@ class OpenAIProvider(BaseProvider):
             data["top_k"] = self.parsed_options.top_k
         if self.parsed_options.logprobs is not None:
             data["logprobs"] = self.parsed_options.logprobs
+        if self.stream_usage:
+            data["stream_options"] = {"include_usage": True}
         if isinstance(prompt, str):
             if self.parsed_options.chat:
                 if images is None:
@@ -465,6 +1942,14 @@ class OpenAIProvider(BaseProvider):
                 prompt_usage_tokens=None,
             )
         usage = data.get("usage", None)
+        if not data.get("choices"):
+            # the trailing chunk requested with stream_options only has usage
+            return ChunkMetadata(
+                text="",
+                logprob_tokens=None,
+                usage_tokens=usage["completion_tokens"] if usage else None,
+                prompt_usage_tokens=usage.get("prompt_tokens", None) if usage else None,
+            )
 
         assert len(data["choices"]) == 1, f"Too many choices {len(data['choices'])}"
         choice = data["choices"][0]
@@ -508,6 +1993,8 @@ class VllmProvider(OpenAIProvider):
 
 
 class TogetherProvider(OpenAIProvider):
+    SUPPORTS_STREAM_USAGE = False
+
     def get_url(self):
         assert not self.parsed_options.chat, "Chat is not supported"
         return "/"
@@ -523,6 +2010,15 @@ class TogetherProvider(OpenAIProvider):
             data = data["output"]
         return super().parse_output_json(data)
 
+    def is_trailing_chunk(self, data):
+        if not self.parsed_options.stream:
+            data = data["output"]
+        return super().is_trailing_chunk(data)
+
+    def reports_completion_tokens(self):
+        # the legacy "output" envelope doesn't carry usage
+        return BaseProvider.reports_completion_tokens(self)
+
 
 class TgiProvider(BaseProvider):
     DEFAULT_MODEL_NAME = "<unused>"
@@ -569,6 +2065,10 @@ class TgiProvider(BaseProvider):
                 prompt_usage_tokens=None,
             )
 
+    def reports_completion_tokens(self):
+        # every streamed chunk is one token
+        return self.parsed_options.stream or super().reports_completion_tokens()
+
 
 PROVIDER_CLASS_MAP = {
     "fireworks": FireworksProvider,
@@ -604,6 +2104,9 @@ class LLMUser(HttpUser):
     def on_start(self):
         try:
             self._on_start()
+        except StopUser:
+            # a closed-loop user can run out of trace on its first wait
+            raise
         except Exception as e:
             print(f"Failed to initialize: {repr(e)}")
             print(traceback.format_exc())
@@ -662,6 +2165,33 @@ class LLMUser(HttpUser):
                     f"Can't detect provider, specify it explicitly with --provider, owned_by={owned_by}"
                 )
 
+    # the outcome of the stream_options check, shared by all users of the process
+    _stream_usage_lock = gevent.lock.Semaphore()
+    _stream_usage_accepted = None
+
+    def _negotiate_stream_usage(self):
+        """Checks once that the server accepts stream_options, stops sending it otherwise."""
+        if not self.provider_formatter.stream_usage:
+            return
+        with LLMUser._stream_usage_lock:
+            if LLMUser._stream_usage_accepted is None:
+                data = self.provider_formatter.format_payload("Hi", 1, None)
+                with self.client.post(
+                    self.provider_formatter.get_url(),
+                    data=orjson.dumps(data),
+                    catch_response=True,
+                    name="stream_options check",
+                ) as response:
+                    LLMUser._stream_usage_accepted = response.ok
+                    if not response.ok:
+                        print(
+                            f"WARNING: server rejected stream_options with {response.status_code}: {response.text[:200]}, "
+                            "counting tokens without the usage chunk"
+                        )
+                    # it's not part of the measurement
+                    response.success()
+        self.provider_formatter.stream_usage = LLMUser._stream_usage_accepted
+
     def _on_start(self):
         self.client.headers["Content-Type"] = "application/json"
         if self.environment.parsed_options.api_key:
@@ -679,11 +2209,12 @@ class LLMUser(HttpUser):
         )
 
         self.stream = self.environment.parsed_options.stream
+        self._negotiate_stream_usage()
 
         image_resolutions = (
             self.environment.parsed_options.prompt_images_with_resolutions
         )
-        self.prompt_images = None
+        self.image_pool = None
         if image_resolutions:
             if not self.environment.parsed_options.chat:
                 # Using regular /completions endpoint, each model has it's own image placeholder
@@ -692,10 +2223,45 @@ class LLMUser(HttpUser):
                 raise AssertionError(
                     "--prompt-images-with-resolutions is only supported with --chat mode."
                 )
-            self.prompt_images = [
-                self._create_base64_image(width, height)
-                for width, height in image_resolutions
-            ]
+            seed = self.environment.parsed_options.seed
+            cache_dir = self.environment.parsed_options.cache_dir
+            if seed is None:
+                # new images for every run, so the server can't have them cached
+                # from an earlier one; they're never reused, so not stored either
+                seed = random.getrandbits(32)
+                cache_dir = None
+            self.image_pool = ImagePool.get_instance(
+                image_resolutions,
+                self.environment.parsed_options.prompt_images_pool_size,
+                cache_dir=cache_dir,
+                seed=seed,
+            )
+
+        self.request_log = RequestLog._instance
+        # printing every response costs client throughput at high QPS, the
+        # request log replaces it
+        self.print_responses = self.environment.parsed_options.print_responses
+        if self.print_responses is None:
+            self.print_responses = self.request_log is None
+
+        self.slo_thresholds = _slo_thresholds(self.environment.parsed_options)
+        if not self.stream and "ttft" in self.slo_thresholds:
+            raise ValueError("--slo-ttft requires --stream")
+
+        self.token_counter = None
+        if (
+            self.environment.parsed_options.tokenizer
+            and self.environment.parsed_options.count_tokens
+        ):
+            self.token_counter = TokenCounter.get_instance(
+                self.environment.parsed_options.tokenizer
+            )
+        # the completion text is only kept for counting when the response won't
+        # have the number of tokens
+        self.count_completion_text = (
+            self.token_counter is not None
+            and not self.provider_formatter.reports_completion_tokens()
+        )
 
         self.max_tokens_sampler = LengthSampler(
             distribution=self.environment.parsed_options.max_tokens_distribution,
@@ -714,6 +2280,7 @@ class LLMUser(HttpUser):
             "stream": self.stream,
             "temperature": self.temperature,
             "logprobs": self.environment.parsed_options.logprobs,
+            "stream_usage": self.provider_formatter.stream_usage,
         }
 
         if self.environment.parsed_options.top_k is not None:
@@ -721,16 +2288,76 @@ class LLMUser(HttpUser):
 
         InitTracker.notify_init(self.environment, logging_params)
 
-        if self.environment.parsed_options.qps is not None:
+        dataset = DatasetHolder.get_instance(self.environment.parsed_options)
+        self.dataset_source = dataset
+        self.dataset = iter(dataset)
+
+        self.prefix_workload = None
+        if self.environment.parsed_options.prefix_groups:
+            self.prefix_workload = PrefixCacheWorkload.get_instance(
+                dataset, self.environment.parsed_options
+            )
+
+        self.request_plan = None
+        if self.environment.parsed_options.request_plan:
+            if self.prefix_workload is not None:
+                raise ValueError("--prefix-groups can't be used with --request-plan")
+            self.request_plan = RequestPlan.get_instance(
+                self.environment.parsed_options,
+                {
+                    "url": self.provider_formatter.get_url(),
+                    "chat": self.environment.parsed_options.chat,
+                    "dataset": self.environment.parsed_options.dataset,
+                    **logging_params,
+                },
+                self._prepare_request,
+            )
+
+        # when the pacer wanted the next request to go out, used to correct its
+        # latency for a late dispatch (coordinated omission)
+        self.intended_start = None
+        self.trace_record = None
+        self.open_loop = self.environment.parsed_options.open_loop
+
+        pacer = None
+        if self.environment.parsed_options.trace:
+            if (
+                self.environment.parsed_options.qps is not None
+                or self.environment.parsed_options.burst
+            ):
+                raise ValueError("--trace is mutually exclusive with --qps and --burst")
+            if self.request_plan is not None:
+                raise ValueError("--trace can't be used with --request-plan")
+            if not isinstance(dataset, LimericsDataset):
+                raise ValueError("--trace requires the limerics dataset")
+            pacer = TraceReplayPacer.instance(
+                self.environment.parsed_options.trace,
+                self.environment.parsed_options.trace_speedup,
+            )
+        elif self.environment.parsed_options.qps is not None:
             if self.environment.parsed_options.burst:
                 raise ValueError("Burst and QPS modes are mutually exclusive")
             pacer = FixedQPSPacer.instance(
                 self.environment.parsed_options.qps,
                 self.environment.parsed_options.qps_distribution,
             )
-            # it will be called by Locust after each task
-            self.wait_time = pacer.wait_time_till_next
-            self.wait()
+        if self.open_loop and pacer is None:
+            raise ValueError("--open-loop requires --qps or --trace")
+
+        if pacer is not None:
+            self.pacer = pacer
+            if self.open_loop:
+                # every request runs on its own greenlet, the user only dispatches them
+                self.in_flight = gevent.pool.Group()
+                adapter = HTTPAdapter(
+                    pool_connections=1, pool_maxsize=OPEN_LOOP_POOL_SIZE
+                )
+                self.client.mount("http://", adapter)
+                self.client.mount("https://", adapter)
+            else:
+                # it will be called by Locust after each task
+                self.wait_time = self._wait_for_next_arrival
+                self.wait()
         elif self.environment.parsed_options.burst:
             self.wait_time = partial(
                 constant_pacing(self.environment.parsed_options.burst), self
@@ -739,24 +2366,48 @@ class LLMUser(HttpUser):
             # introduce initial delay to avoid all users hitting the service at the same time
             time.sleep(random.random())
 
-        self.first_done = False
+        self.session_turns = self.environment.parsed_options.session_turns
+        self.session_messages = []
+        if self.session_turns:
+            options = self.environment.parsed_options
+            if not options.chat or options.embeddings:
+                raise ValueError("--session-turns requires --chat")
+            if self.open_loop or options.trace or self.request_plan is not None:
+                raise ValueError(
+                    "--session-turns can't be used with --open-loop, --trace or --request-plan"
+                )
+            if self.image_pool is not None:
+                raise ValueError(
+                    "--session-turns doesn't support --prompt-images-with-resolutions"
+                )
+            if self.provider not in ("openai", "vllm", "sglang", "fireworks"):
+                raise ValueError(f"--session-turns isn't supported for {self.provider}")
+            # sessions start at the pace of the configured mode, turns follow the think time
+            self._new_session_wait_time = self.wait_time
+            self.wait_time = self._session_wait_time
 
-        dataset = DatasetHolder.get_instance(self.environment.parsed_options)
-        self.dataset = iter(dataset)
+        if self.environment.parsed_options.probe_qps:
+            if not self.stream:
+                raise ValueError("--probe-qps requires --stream")
+            ProbeStream.register(self)
 
-    def _create_base64_image(self, width, height):
-        """Create a random RGB image with the given dimensions and return as base64 data URI."""
-        img = Image.new("RGB", (width, height))
-        buffer = io.BytesIO()
-        img.save(buffer, format="JPEG")
-        img_str = base64.b64encode(buffer.getvalue()).decode("utf-8")
-        return f"data:image/jpeg;base64,{img_str}"
+        self.first_done = False
 
-    def _get_input(self):
-        prompt, prompt_tokens = next(self.dataset)
+    def _get_input(self, num_tokens=None):
+        prefix_group = None
+        if self.prefix_workload is not None:
+            if num_tokens is None:
+                num_tokens = self.environment.parsed_options.prompt_tokens
+            prompt, prompt_tokens, prefix_group = self.prefix_workload.sample(
+                num_tokens
+            )
+        elif num_tokens is not None:
+            prompt, prompt_tokens = self.dataset_source.sample(num_tokens)
+        else:
+            prompt, prompt_tokens = next(self.dataset)
 
-        if self.prompt_images:
-            images = self.prompt_images
+        if self.image_pool is not None:
+            images = self.image_pool.sample()
             prompt_images_positioning = (
                 self.environment.parsed_options.prompt_images_positioning
             )
@@ -766,7 +2417,7 @@ class LLMUser(HttpUser):
         else:
             images = None
 
-        return prompt, prompt_tokens, images
+        return prompt, prompt_tokens, images, prefix_group
 
     def insert_image_placeholders(self, prompt, num_images, prompt_images_positioning):
         if num_images <= 0:
@@ -809,20 +2460,182 @@ class LLMUser(HttpUser):
                 f"Invalid prompt images positioning: {prompt_images_positioning}"
             )
 
+    def on_stop(self):
+        ProbeStream.unregister(self)
+        if getattr(self, "open_loop", False):
+            self.in_flight.kill(block=False)
+
     @task
     def generate_text(self):
+        if self.open_loop:
+            self._dispatch_open_loop()
+        elif self.session_turns:
+            self._run_session_turn()
+        else:
+            self._generate_text(self.intended_start, self.trace_record)
+
+    def _run_session_turn(self):
+        """Sends the next turn of the user's chat session, with the whole conversation so far."""
+        prompt, _, _, prefix_group = self._get_input()
+        messages = self.session_messages + [{"role": "user", "content": prompt}]
         max_tokens = self.max_tokens_sampler.sample()
-        prompt, prompt_usage_tokens, images = self._get_input()
+        data = self.provider_formatter.format_payload(
+            {"messages": messages}, max_tokens, None
+        )
+        request = PreparedRequest(
+            body=json.dumps(data).encode(),
+            max_tokens=max_tokens,
+            prompt_tokens=0,  # the server reports the size of the whole context
+            prefix_group=prefix_group,
+            turn=len(self.session_messages) // 2 + 1,
+        )
+        reply = None
+        try:
+            reply = self._generate_text(self.intended_start, request=request)
+        finally:
+            if reply is None or request.turn >= self.session_turns:
+                # start over after the last turn or a failure
+                self.session_messages = []
+            else:
+                self.session_messages = messages + [
+                    {"role": "assistant", "content": reply}
+                ]
+
+    def _session_wait_time(self):
+        if self.session_messages:
+            # the next turn follows the reply after the think time, it's not paced
+            self.intended_start = None
+            return self.environment.parsed_options.session_think_time
+        return self._new_session_wait_time()
+
+    def _wait_for_next_arrival(self):
+        arrival = self.pacer.next_arrival()
+        if arrival is None:
+            self._finish_trace()
+        self.intended_start, self.trace_record = arrival
+        return self.pacer.wait_time_till(self.intended_start)
+
+    def _finish_trace(self):
+        if self.open_loop:
+            self.in_flight.join()
+        TraceReplayPacer.notify_user_finished(self.environment)
+        raise StopUser()
+
+    def _dispatch_open_loop(self):
+        """Wait for the next scheduled arrival and fire the request on its own greenlet.
+
+        The user never blocks on the response, so the arrival rate doesn't depend on
+        how many requests are in flight or how slow the server is.
+        """
+        arrival = self.pacer.next_arrival()
+        if arrival is None:
+            self._finish_trace()
+        t, trace_record = arrival
+        delay = t - time.time()
+        if delay > 0:
+            gevent.sleep(delay)
+        self.in_flight.spawn(self._run_open_loop_request, t, trace_record)
+
+    def _run_open_loop_request(self, intended_start, trace_record, request=None):
+        try:
+            self._generate_text(intended_start, trace_record, request)
+        except Exception as e:
+            # mimic what Locust does for exceptions escaping a task
+            print(f"Request failed: {repr(e)}")
+            self.environment.events.user_error.fire(
+                user_instance=self, exception=e, tb=e.__traceback__
+            )
+
+    def _iter_response_events(self, response):
+        """Yields `(arrival_time, payload)` for every event of the response body."""
+        if not self.stream or self.provider_formatter.parsed_options.embeddings:
+            body = response.content
+            yield time.perf_counter(), body
+            return
+        parser = SSEParser()
+        # chunk_size=None hands over every chunk of the chunked body as soon as it arrives
+        for raw in response.iter_content(chunk_size=None):
+            now = time.perf_counter()
+            for payload in parser.feed(raw):
+                yield now, payload
+        for payload in parser.close():
+            yield time.perf_counter(), payload
+
+    def _prepare_request(self, trace_record=None):
+        if trace_record is not None:
+            max_tokens = max(1, trace_record.output_length)
+            prompt, prompt_tokens, images, prefix_group = self._get_input(
+                trace_record.input_length
+            )
+        else:
+            max_tokens = self.max_tokens_sampler.sample()
+            prompt, prompt_tokens, images, prefix_group = self._get_input()
+        data = self.provider_formatter.format_payload(prompt, max_tokens, images)
+        return PreparedRequest(
+            body=json.dumps(data).encode(),
+            max_tokens=max_tokens,
+            prompt_tokens=prompt_tokens,
+            prefix_group=prefix_group,
+        )
+
+    def _prepare_probe_request(self):
+        prompt, prompt_tokens, images, _ = self._get_input()
+        max_tokens = self.environment.parsed_options.probe_max_tokens
         data = self.provider_formatter.format_payload(prompt, max_tokens, images)
+        return PreparedRequest(
+            body=json.dumps(data).encode(),
+            max_tokens=max_tokens,
+            prompt_tokens=prompt_tokens,
+            probe=True,
+        )
+
+    def _generate_text(self, intended_start=None, trace_record=None, request=None):
+        """Sends one request and logs its metrics, returns the generated text if it was kept."""
+        if request is None:
+            if self.request_plan is not None:
+                request = next(self.request_plan)
+            else:
+                request = self._prepare_request(trace_record)
+        max_tokens = request.max_tokens
+        prompt_usage_tokens = request.prompt_tokens
         t_start = time.perf_counter()
+        if intended_start is not None:
+            dispatch_delay = max(0.0, time.time() - intended_start)
+        else:
+            dispatch_delay = None
+        log = None
+        if self.request_log is not None:
+            log = {
+                "intended_start": intended_start,
+                "start": time.time(),
+                "max_tokens": max_tokens,
+            }
+            if request.prefix_group is not None:
+                log["prefix_group"] = request.prefix_group
+            if request.turn is not None:
+                log["turn"] = request.turn
+            if request.probe:
+                log["probe"] = True
 
         with self.client.post(
             self.provider_formatter.get_url(),
-            data=json.dumps(data),
+            data=request.body,
             stream=True,
             catch_response=True,
+            name=PROBE_REQUEST_NAME if request.probe else None,
         ) as response:
-            combined_text = ""
+            # the full text is only needed for printing and as the next turn's
+            # context, otherwise just count it
+            show_response = self.environment.parsed_options.show_response
+            # without usage or logprobs in the response the completion tokens
+            # are counted from the text
+            keep_text = (
+                show_response
+                or request.turn is not None
+                or self.count_completion_text
+            )
+            text_parts = []
+            num_chars = 0
             done_empty_chunk = False
             done = False
             total_usage_tokens = None
@@ -830,56 +2643,80 @@ class LLMUser(HttpUser):
             try:
                 response.raise_for_status()
             except Exception as e:
-                raise RuntimeError(f"Error in response: {response.text}") from e
+                self._log_request(log, status=response.status_code, error=type(e).__name__)
+                # raising here would skip Locust's request event, so the
+                # failure would never be counted
+                response.failure(f"Error in response: {response.text}")
+                self._record_slo_miss(request)
+                return
             t_first_token = None
-            for chunk in response.iter_lines(delimiter=b"\n\n"):
-                if len(chunk) == 0:
-                    continue  # come providers send empty lines between data chunks
-                if done:
-                    if chunk != b"data: [DONE]":
-                        print(f"WARNING: Received more chunks after [DONE]: {chunk}")
-                try:
-                    now = time.perf_counter()
+            timeline = TokenTimeline() if self.stream else None
+            chunk = None
+            try:
+                for now, chunk in self._iter_response_events(response):
+                    if len(chunk) == 0:
+                        continue  # come providers send empty lines between data chunks
+                    if done:
+                        if chunk.strip() != b"[DONE]":
+                            print(f"WARNING: Received more chunks after [DONE]: {chunk}")
                     if self.provider_formatter.parsed_options.embeddings:
                         t_first_token = now
-                        if self.environment.parsed_options.show_response:
+                        if keep_text:
                             out = self.provider_formatter.parse_output_json(orjson.loads(chunk))
-                            combined_text = out.text
+                            text_parts.append(out.text)
+                            num_chars = len(out.text)
                         break
-                    if self.stream:
-                        assert chunk.startswith(
-                            b"data:"
-                        ), f"Unexpected chunk not starting with 'data': {chunk}"
-                        chunk = chunk[len(b"data:") :]
-                        if chunk.strip() == b"[DONE]":
-                            done = True
-                            continue
+                    if self.stream and chunk.strip() == b"[DONE]":
+                        done = True
+                        continue
                     if done_empty_chunk:
                         print(f"WARNING: Received more chunks after the trailing last chunk: {chunk}")
                     data = orjson.loads(chunk)
-                    if not data.get("choices"):
+                    if self.provider_formatter.is_trailing_chunk(data):
                         done_empty_chunk = True
-                        continue
+                        # the trailing chunk has the usage with --stream-usage
+                        if not data.get("usage"):
+                            continue
                     out = self.provider_formatter.parse_output_json(data)
                     if out.usage_tokens:
                         total_usage_tokens = out.usage_tokens
                     if out.prompt_usage_tokens:
                         prompt_usage_tokens = out.prompt_usage_tokens
-                    combined_text += out.text
+                    if out.text:
+                        num_chars += len(out.text)
+                        if keep_text:
+                            text_parts.append(out.text)
 
                     # some providers (SGLang) send an empty chunk first skewing the TTFT
-                    if combined_text and t_first_token is None:
+                    if num_chars and t_first_token is None:
                         t_first_token = now
+                    if (
+                        timeline is not None
+                        and t_first_token is not None
+                        and (out.text or out.logprob_tokens)
+                    ):
+                        timeline.add(now, out.logprob_tokens or 0)
 
                     if out.logprob_tokens:
                         total_logprob_tokens = (
                             total_logprob_tokens or 0
                         ) + out.logprob_tokens
-                except Exception as e:
-                    print(f"Failed to parse response: {chunk} with error {repr(e)}")
-                    response.failure(e)
-                    return
-            assert t_first_token is not None, "empty response received"
+            except Exception as e:
+                print(f"Failed to parse response: {chunk} with error {repr(e)}")
+                self._log_request(
+                    log,
+                    status=response.status_code,
+                    error=type(e).__name__,
+                    chunks=len(timeline) if timeline is not None else None,
+                )
+                response.failure(e)
+                self._record_slo_miss(request)
+                return
+            if t_first_token is None:
+                self._log_request(log, status=response.status_code, error="EmptyResponse")
+                response.failure("empty response received")
+                self._record_slo_miss(request)
+                return
             if (
                 (total_logprob_tokens is not None)
                 and (total_usage_tokens is not None)
@@ -894,49 +2731,173 @@ class LLMUser(HttpUser):
                 num_tokens = total_usage_tokens
 
             num_tokens = num_tokens or 0
-            num_chars = len(combined_text)
             now = time.perf_counter()
             dur_total = now - t_start
             dur_generation = now - t_first_token
             dur_first_token = t_first_token - t_start
-            print(
-                f"Response received: total {dur_total*1000:.2f} ms, first token {dur_first_token*1000:.2f} ms, {num_chars} chars, {num_tokens} tokens"
-            )
-            if self.environment.parsed_options.show_response:
+            if self.print_responses:
+                print(
+                    f"Response received: total {dur_total*1000:.2f} ms, first token {dur_first_token*1000:.2f} ms, {num_chars} chars, {num_tokens} tokens"
+                )
+            if show_response:
                 print("---")
-                print(combined_text)
+                if self.provider_formatter.parsed_options.embeddings:
+                    print(text_parts[0])
+                else:
+                    print("".join(text_parts))
                 print("---")
-            if num_chars:
-                add_custom_metric(
-                    "latency_per_char", dur_generation / num_chars * 1000, num_chars
+            if request.probe:
+                self._record_probe(dur_first_token, dur_total, num_tokens, dispatch_delay)
+                self._log_request(
+                    log,
+                    ttft=dur_first_token * 1000,
+                    output_tokens=num_tokens or None,
+                    chunks=len(timeline),
+                    status=response.status_code,
+                    error=None,
                 )
+                return
+            if num_chars:
+                add_custom_metric("latency_per_char", dur_generation / num_chars * 1000)
             if self.stream:
                 add_custom_metric("time_to_first_token", dur_first_token * 1000)
+                if request.turn is not None:
+                    add_custom_metric(
+                        f"turn_{request.turn}_time_to_first_token",
+                        dur_first_token * 1000,
+                    )
+                if request.prefix_group is not None:
+                    add_custom_metric(
+                        f"{request.prefix_group}_time_to_first_token",
+                        dur_first_token * 1000,
+                    )
+            if timeline is not None and len(timeline) > 1:
+                itls = timeline.inter_token_latencies()
+                add_custom_metric_values("inter_token_latency", itls)
+                add_custom_metric("max_stall", max(itls))
+                if total_logprob_tokens is not None:
+                    add_custom_metric_values("tokens_per_chunk", timeline.tokens)
             add_custom_metric("total_latency", dur_total * 1000)
-            if num_tokens:
-                if num_tokens != max_tokens:
-                    print(
-                        f"WARNING: wrong number of tokens: {num_tokens}, expected {max_tokens}"
+            if dispatch_delay is not None:
+                # latency as seen by a client that sent the request on schedule
+                add_custom_metric("dispatch_delay", dispatch_delay * 1000)
+                if dispatch_delay * 1000 > LATE_DISPATCH_THRESHOLD_MS:
+                    add_custom_metric("late_dispatch_delay", dispatch_delay * 1000)
+                if self.stream:
+                    add_custom_metric(
+                        "time_to_first_token_corrected",
+                        (dur_first_token + dispatch_delay) * 1000,
                     )
-                add_custom_metric("num_tokens", num_tokens)
                 add_custom_metric(
-                    "latency_per_token", dur_generation / num_tokens * 1000, num_tokens
+                    "total_latency_corrected", (dur_total + dispatch_delay) * 1000
                 )
-                add_custom_metric(
-                    "overall_latency_per_token",
-                    dur_total / num_tokens * 1000,
-                    num_tokens,
+            embeddings = self.provider_formatter.parsed_options.embeddings
+            self._log_request(
+                log,
+                ttft=dur_first_token * 1000 if self.stream else None,
+                prompt_tokens=prompt_usage_tokens or None,
+                output_tokens=num_tokens or None,
+                chunks=len(timeline) if timeline is not None else None,
+                status=response.status_code,
+                error=None,
+            )
+            if num_tokens:
+                self._record_completion_tokens(
+                    num_tokens, max_tokens, dur_generation, dur_total
+                )
+                self._record_slo(dur_first_token, dur_generation, dur_total, num_tokens)
+            elif self.count_completion_text and not embeddings:
+
+                def on_completion_counted(n):
+                    if log is not None:
+                        log["output_tokens"] = n
+                    self._record_completion_tokens(
+                        n, max_tokens, dur_generation, dur_total
+                    )
+                    self._record_slo(dur_first_token, dur_generation, dur_total, n)
+
+                self.token_counter.count_completion(
+                    "".join(text_parts), on_completion_counted
                 )
+            else:
+                self._record_slo(dur_first_token, dur_generation, dur_total, 0)
+
+            if not embeddings:
+                if prompt_usage_tokens:
+                    add_custom_metric("prompt_tokens", prompt_usage_tokens)
+                elif self.token_counter is not None:
 
-            if not self.provider_formatter.parsed_options.embeddings:
-                prompt_tokens = prompt_usage_tokens or self.prompt_tokenizer_tokens
-                if prompt_tokens:
-                    add_custom_metric("prompt_tokens", prompt_tokens)
+                    def on_prompt_counted(n):
+                        if log is not None:
+                            log["prompt_tokens"] = n
+                        add_custom_metric("prompt_tokens", n)
+
+                    self.token_counter.count_prompt(request.body, on_prompt_counted)
 
             if not self.first_done:
                 self.first_done = True
                 InitTracker.notify_first_request()
 
+            if keep_text and not embeddings:
+                return "".join(text_parts)
+
+    def _record_slo(self, dur_first_token, dur_generation, dur_total, num_tokens):
+        """Records which of the --slo-* thresholds the request met.
+
+        TPOT is the generation time per output token, like latency_per_token, and
+        counts as missed when the number of tokens isn't known.
+        """
+        if not self.slo_thresholds:
+            return
+        values = {
+            "ttft": dur_first_token * 1000,
+            "tpot": dur_generation / num_tokens * 1000 if num_tokens else None,
+            "e2e": dur_total * 1000,
+        }
+        met_all = True
+        for name, limit in self.slo_thresholds.items():
+            met = values[name] is not None and values[name] <= limit
+            add_custom_metric(f"slo_{name}_met", int(met))
+            met_all = met_all and met
+        add_custom_metric("slo_met", int(met_all))
+        if met_all:
+            add_custom_metric("goodput_tokens", num_tokens)
+
+    def _record_slo_miss(self, request):
+        """Records a failed main-load request as missing every --slo-* threshold."""
+        if not self.slo_thresholds or request.probe:
+            return
+        for name in self.slo_thresholds:
+            add_custom_metric(f"slo_{name}_met", 0)
+        add_custom_metric("slo_met", 0)
+
+    @staticmethod
+    def _record_probe(dur_first_token, dur_total, num_tokens, dispatch_delay):
+        add_custom_metric("probe_time_to_first_token", dur_first_token * 1000)
+        add_custom_metric("probe_total_latency", dur_total * 1000)
+        if num_tokens:
+            add_custom_metric("probe_num_tokens", num_tokens)
+        if dispatch_delay is not None:
+            add_custom_metric("probe_dispatch_delay", dispatch_delay * 1000)
+
+    def _log_request(self, log, **fields):
+        if log is None:
+            return
+        log.update(fields, end=time.time())
+        self.request_log.add(log)
+
+    @staticmethod
+    def _record_completion_tokens(num_tokens, max_tokens, dur_generation, dur_total):
+        if not num_tokens:
+            return
+        if num_tokens != max_tokens:
+            print(
+                f"WARNING: wrong number of tokens: {num_tokens}, expected {max_tokens}"
+            )
+        add_custom_metric("num_tokens", num_tokens)
+        add_custom_metric("latency_per_token", dur_generation / num_tokens * 1000)
+        add_custom_metric("overall_latency_per_token", dur_total / num_tokens * 1000)
+
 
 def parse_resolution(res_str):
     """Parse a resolution string like '3084x1080' into a tuple of integers (width, height)."""
@@ -965,6 +2926,13 @@ def init_parser(parser):
         help="Either 'limerics' or a path to a JSONL file",
         default="limerics",
     )
+    parser.add_argument(
+        "--dataset-sampling",
+        type=str,
+        choices=["sequential", "random", "shuffle", "shard"],
+        default="sequential",
+        help="How requests are picked from a JSONL dataset: in file order ('sequential'), uniformly at random ('random'), in random order without repetition ('shuffle') or in file order with every worker taking its own share of the lines in distributed mode ('shard'). All users of a process share the same sequence",
+    )
     parser.add_argument(
         "-m",
         "--model",
@@ -976,7 +2944,20 @@ def init_parser(parser):
         "--tokenizer",
         env_var="TOKENIZER",
         type=str,
-        help="Specify HF tokenizer to use for validating the output of the model. It's optional, we're going to rely on 'usage' or 'logprobs' field to get token count information",
+        help="Specify HF tokenizer to use for validating the output of the model. It's optional, we're going to rely on 'usage' or 'logprobs' field to get token count information and count tokens with the tokenizer when they are missing (see --count-tokens)",
+    )
+    parser.add_argument(
+        "--count-tokens",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Count prompt and completion tokens with --tokenizer when the response has neither usage nor logprobs. Counting runs in a background thread and doesn't delay requests",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        env_var="CACHE_DIR",
+        type=str,
+        default=os.path.expanduser("~/.cache/llm-load-test"),
+        help="Directory for caching expensive startup work, like the tokenized limerics dataset. Pass an empty string to disable",
     )
     parser.add_argument(
         "--chat",
@@ -1022,6 +3003,12 @@ def init_parser(parser):
         "Images will be spaced out evenly across the prompt."
         "Only supported with --chat mode.",
     )
+    parser.add_argument(
+        "--prompt-images-pool-size",
+        type=int,
+        default=1024,
+        help="Number of distinct images generated per resolution in --prompt-images-with-resolutions. Every request picks one at random. Keep it above the number of images the server's multimodal cache holds, otherwise most requests hit that cache. Without --seed every run renders new images, with --seed they're the same every run and cached in --cache-dir. Defaults to 1024",
+    )
     parser.add_argument(
         "--prompt-images-positioning",
         type=str,
@@ -1032,6 +3019,42 @@ def init_parser(parser):
         "end: images are added to the end of the prompt. E.g., 3 images in 'abcdefgh' is 'abcdefgh<image><image><image>'"
         "Only relevant with --prompt-images-with-resolutions.",
     )
+    parser.add_argument(
+        "--session-turns",
+        type=int,
+        default=0,
+        help="Multi-turn chat workload: every user runs conversations of the specified number of turns, each turn sends the whole conversation so far (including the model's actual replies) plus a new user message of --prompt-tokens. TTFT is reported per turn. Requires --chat. Defaults to 0 (single independent requests)",
+    )
+    parser.add_argument(
+        "--session-think-time",
+        type=float,
+        default=0.0,
+        help="Must be used with --session-turns. Seconds between receiving a reply and sending the next turn. New sessions follow the regular pacing (--qps, --burst or back to back). Defaults to 0",
+    )
+    parser.add_argument(
+        "--prefix-groups",
+        type=int,
+        default=0,
+        help="Prefix caching workload: prompts start with one of the specified number of shared prefixes. TTFT is reported per prefix group. Requires the limerics dataset. Defaults to 0 (disabled)",
+    )
+    parser.add_argument(
+        "--prefix-fraction",
+        type=float,
+        default=0.5,
+        help="Must be used with --prefix-groups. Share of --prompt-tokens taken by the shared prefix. Defaults to 0.5",
+    )
+    parser.add_argument(
+        "--prefix-hit-ratio",
+        type=float,
+        default=1.0,
+        help="Must be used with --prefix-groups. Share of requests that use one of the shared prefixes, the others get a unique prefix of the same length. Defaults to 1.0",
+    )
+    parser.add_argument(
+        "--prefix-zipf",
+        type=float,
+        default=0.0,
+        help="Must be used with --prefix-groups. Exponent of the Zipf distribution of prefix popularity, 0 picks all prefixes equally often. Defaults to 0",
+    )
     parser.add_argument(
         "-o",
         "--max-tokens",
@@ -1092,18 +3115,78 @@ def init_parser(parser):
         "--logprobs",
         type=int,
         default=None,
-        help="Whether to ask for logprobs, it makes things slower for some providers but is necessary for token count in streaming (unless it's Fireworks API that returns usage in streaming mode)",
+        help="Whether to ask for logprobs, it makes things slower for some providers. Token counts in streaming mode come from the usage chunk (see --stream-usage) and only need logprobs if the server doesn't support it",
+    )
+    parser.add_argument(
+        "--stream-usage",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Ask OpenAI-compatible servers for a final usage chunk in streaming mode (stream_options.include_usage) to get exact token counts without logprobs. It's checked with one small request at startup and dropped if the server rejects it",
     )
     parser.add_argument(
         "--summary-file",
         type=str,
         help="Append the line with the summary to the specified CSV file. Useful for generating a spreadsheet with perf sweep results. If the file doesn't exist, writes out the header first",
     )
+    parser.add_argument(
+        "--slo-ttft",
+        type=float,
+        default=None,
+        help="SLO for the time to first token in ms. With any --slo-* option the summary reports goodput (requests and output tokens per second of the requests that met all SLOs) and the attainment of every SLO",
+    )
+    parser.add_argument(
+        "--slo-tpot",
+        type=float,
+        default=None,
+        help="SLO for the time per output token in ms, the generation time after the first token divided by the number of output tokens (same as Latency Per Token). Requests without a known token count miss it",
+    )
+    parser.add_argument(
+        "--slo-e2e",
+        type=float,
+        default=None,
+        help="SLO for the total latency of a request in ms",
+    )
+    parser.add_argument(
+        "--control-port",
+        type=int,
+        default=None,
+        help="Listen on this port on 127.0.0.1 for changing the load of the running test: GET /stats returns the summary so far, POST /control with a JSON body like {\"qps\": 20, \"users\": 30, \"reset_stats\": true} changes the QPS and the number of users and restarts the measurement, POST /stop ends the test",
+    )
+    parser.add_argument(
+        "--request-log",
+        type=str,
+        default=None,
+        help="Append a JSONL record for every request to this file: intended_start, start and end (unix time), ttft (ms), prompt_tokens, output_tokens, chunks, status, error (exception class) and the prefix group or session turn. Written in the background in batches. In distributed mode every worker writes its own file with a .worker<N> suffix",
+    )
+    parser.add_argument(
+        "--print-responses",
+        action=argparse.BooleanOptionalAction,
+        default=None,
+        help="Print a line for every received response. On by default unless --request-log is used",
+    )
+    parser.add_argument(
+        "--timeseries-file",
+        type=str,
+        default=None,
+        help="Write requests, failures, QPS, tokens/s and TTFT/ITL/total latency percentiles for every --timeseries-interval window to this file while the test runs. CSV, or Parquet if the name ends with .parquet (requires pyarrow). In distributed mode every worker writes its own file with a .worker<N> suffix",
+    )
+    parser.add_argument(
+        "--timeseries-interval",
+        type=float,
+        default=1.0,
+        help="Length of the --timeseries-file windows in seconds",
+    )
     parser.add_argument(
         "--qps",
         type=float,
         default=None,
-        help="Enabled 'fixed QPS' mode where requests are issues at the specified rate regardless of how long the processing takes. In this case --users and --spawn-rate need to be set to a sufficiently high value (e.g. 100)",
+        help="Enabled 'fixed QPS' mode where requests are issues at the specified rate regardless of how long the processing takes. In this case --users and --spawn-rate need to be set to a sufficiently high value (e.g. 100), unless --open-loop is used",
+    )
+    parser.add_argument(
+        "--open-loop",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Must be used with --qps or --trace. Every request is fired at its scheduled time on its own greenlet, no matter how many requests are in flight, so the arrival rate doesn't depend on --users or on server latency. A single user (-u 1) is enough",
     )
     parser.add_argument(
         "--qps-distribution",
@@ -1112,6 +3195,30 @@ def init_parser(parser):
         default="constant",
         help="Must be used with --qps. Specifies how to space out requests: equally ('constant') or by sampling wait times from a distribution ('uniform' or 'exponential'). Expected QPS is going to match --qps",
     )
+    parser.add_argument(
+        "--probe-qps",
+        type=float,
+        default=None,
+        help="Also send a probe stream of short requests at this constant rate, independent of the main load. Probe requests are named 'probe' in Locust's stats and their latencies are reported separately as 'Probe Time To First Token' etc., they don't count towards the main metrics, --timeseries-file or the SLOs. Requires --stream",
+    )
+    parser.add_argument(
+        "--probe-max-tokens",
+        type=int,
+        default=100,
+        help="Must be used with --probe-qps. max_tokens of the probe requests",
+    )
+    parser.add_argument(
+        "--trace",
+        type=str,
+        default=None,
+        help="Replay the arrival times and input/output lengths of a production trace: either a CSV in the Azure LLM inference trace format (TIMESTAMP,ContextTokens,GeneratedTokens) or a JSONL file with 'timestamp' (seconds), 'input_length' and 'output_length' fields. Prompts are synthesized from the limerics dataset and the test stops at the end of the trace. Mutually exclusive with --qps",
+    )
+    parser.add_argument(
+        "--trace-speedup",
+        type=float,
+        default=1.0,
+        help="Must be used with --trace. Replays the trace this many times faster than recorded. Defaults to 1",
+    )
     parser.add_argument(
         "--burst",
         type=float,
@@ -1132,6 +3239,24 @@ def init_parser(parser):
         default=0,
         help="Maximum length of the prompt cache to use. Defaults to 0 (no caching).",
     )
+    parser.add_argument(
+        "--request-plan",
+        type=str,
+        default=None,
+        help="Replay pre-serialized requests from the specified plan file, so no payload is built during the test. If the file doesn't exist, it's compiled first from the current dataset and settings (not on distributed workers, they need an existing plan). Copy the file to replay exactly the same requests on another run or machine",
+    )
+    parser.add_argument(
+        "--request-plan-size",
+        type=int,
+        default=10000,
+        help="Number of requests to compile into a new --request-plan file. The plan is replayed in a loop if the test sends more. Defaults to 10000",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=None,
+        help="Seed for the random generator used to build prompts and sample lengths",
+    )
     parser.add_argument(
         "--header",
         action="append",
@@ -1147,16 +3272,15 @@ def init_parser(parser):
     )
 
 
-@events.quitting.add_listener
-def _(environment, **kw):
-    total_latency = environment.stats.entries[("total_latency", "METRIC")]
-    if environment.stats.total.num_failures > 0 or total_latency.num_requests == 0:
-        print("Test failed due to failed requests")
-        environment.process_exit_code = 1
-        return
-
-    entries = copy.copy(InitTracker.logging_params)
-    if environment.parsed_options.qps is not None:
+def build_summary(environment):
+    """Returns the summary entries (pretty name -> value) of the metrics collected since the last reset."""
+    total_latency = CustomMetrics.get("total_latency")
+    entries = copy.copy(InitTracker.logging_params) or {}
+    if environment.parsed_options.trace:
+        entries["concurrency"] = (
+            f"Trace {environment.parsed_options.trace} x{environment.parsed_options.trace_speedup}"
+        )
+    elif environment.parsed_options.qps is not None:
         entries["concurrency"] = (
             f"QPS {environment.parsed_options.qps} {environment.parsed_options.qps_distribution}"
         )
@@ -1170,25 +3294,123 @@ def _(environment, **kw):
         "total_latency",
         "prompt_tokens",  # might overwrite the static value based on server side tokenization
     ]:
-        entries[metric_name] = environment.stats.entries[
-            (metric_name, "METRIC")
-        ].avg_response_time
+        entries[metric_name] = CustomMetrics.get(metric_name).mean
     if not environment.parsed_options.stream:
         # if there's no streaming these metrics are meaningless
         entries["time_to_first_token"] = ""
         entries["latency_per_token"] = ""
-    entries["num_requests"] = total_latency.num_requests
-    entries["qps"] = total_latency.total_rps
+    entries["num_requests"] = total_latency.count
+    entries["qps"] = CustomMetrics.rate("total_latency")
     percentile_to_report = [50, 90, 95, 99, 99.9]
     percentile_metrics = ["time_to_first_token", "total_latency"]
     for percentile_metric in percentile_metrics:
-        metrics = environment.stats.entries[percentile_metric, "METRIC"]
+        metrics = CustomMetrics.get(percentile_metric)
         for percentile in percentile_to_report:
             name = f"P{percentile}_{percentile_metric}"
-            entries[name] = metrics.get_response_time_percentile(percentile / 100)
+            entries[name] = metrics.percentile(percentile / 100)
+
+    if environment.parsed_options.qps is not None or environment.parsed_options.trace:
+        # latencies measured from the scheduled send time, see `dispatch_delay`
+        corrected_metrics = ["total_latency_corrected"]
+        if environment.parsed_options.stream:
+            corrected_metrics.insert(0, "time_to_first_token_corrected")
+        for metric_name in corrected_metrics:
+            metrics = CustomMetrics.get(metric_name)
+            entries[metric_name] = metrics.mean
+            for percentile in percentile_to_report:
+                entries[f"P{percentile}_{metric_name}"] = metrics.percentile(
+                    percentile / 100
+                )
+        dispatch_delay = CustomMetrics.get("dispatch_delay")
+        late_dispatches = CustomMetrics.get("late_dispatch_delay").count
+        entries["late_dispatches"] = late_dispatches
+        entries["late_dispatches_pct"] = (
+            late_dispatches / dispatch_delay.count * 100 if dispatch_delay.count else 0
+        )
+        entries["dispatch_delay"] = dispatch_delay.mean
+        entries["P99_dispatch_delay"] = dispatch_delay.percentile(0.99)
+        entries["max_dispatch_delay"] = dispatch_delay.max or 0
+
+    slo_thresholds = _slo_thresholds(environment.parsed_options)
+    if slo_thresholds:
+        # requests (and their output tokens) per second that met all SLOs
+        entries["goodput"] = CustomMetrics.sum_rate("slo_met")
+        entries["goodput_tokens_per_s"] = CustomMetrics.sum_rate("goodput_tokens")
+        slo_met = CustomMetrics.get("slo_met")
+        entries["slo_attainment_pct"] = slo_met.mean * 100
+        for name in slo_thresholds:
+            entries[f"slo_{name}_attainment_pct"] = (
+                CustomMetrics.get(f"slo_{name}_met").mean * 100
+            )
+
+    if environment.parsed_options.prefix_groups and environment.parsed_options.stream:
+        groups = [f"prefix_{i}" for i in range(environment.parsed_options.prefix_groups)]
+        for group in groups + ["prefix_miss"]:
+            # every group gets its columns, so --summary-file rows line up with the header
+            metrics = CustomMetrics.get(f"{group}_time_to_first_token")
+            entries[f"{group}_requests"] = metrics.count
+            entries[f"{group}_time_to_first_token"] = metrics.mean if metrics.count else ""
+            entries[f"P90_{group}_time_to_first_token"] = (
+                metrics.percentile(0.9) if metrics.count else ""
+            )
+
+    if environment.parsed_options.session_turns and environment.parsed_options.stream:
+        for turn in range(1, environment.parsed_options.session_turns + 1):
+            metrics = CustomMetrics.get(f"turn_{turn}_time_to_first_token")
+            entries[f"turn_{turn}_time_to_first_token"] = metrics.mean
+            entries[f"P90_turn_{turn}_time_to_first_token"] = metrics.percentile(0.9)
+
+    if environment.parsed_options.probe_qps:
+        probe_ttft = CustomMetrics.get("probe_time_to_first_token")
+        entries["probe_requests"] = ProbeStream.num_requests(environment)
+        entries["probe_failures"] = ProbeStream.num_failures(environment)
+        entries["probe_time_to_first_token"] = probe_ttft.mean if probe_ttft.count else ""
+        for percentile in [50, 90, 99]:
+            entries[f"P{percentile}_probe_time_to_first_token"] = (
+                probe_ttft.percentile(percentile / 100) if probe_ttft.count else ""
+            )
+        probe_total_latency = CustomMetrics.get("probe_total_latency")
+        entries["probe_total_latency"] = (
+            probe_total_latency.mean if probe_total_latency.count else ""
+        )
+
+    if environment.parsed_options.stream:
+        itl = CustomMetrics.get("inter_token_latency")
+        for percentile in [50, 90, 99]:
+            entries[f"P{percentile}_inter_token_latency"] = itl.percentile(
+                percentile / 100
+            )
+        entries["max_inter_token_latency"] = itl.max or 0
+        max_stall = CustomMetrics.get("max_stall")
+        entries["max_stall"] = max_stall.mean
+        entries["P99_max_stall"] = max_stall.percentile(0.99)
+        # only known with logprobs, empty otherwise
+        tokens_per_chunk = CustomMetrics.get("tokens_per_chunk")
+        has_chunks = tokens_per_chunk.count > 0
+        entries["tokens_per_chunk"] = tokens_per_chunk.mean if has_chunks else ""
+        entries["P50_tokens_per_chunk"] = (
+            tokens_per_chunk.percentile(0.5) if has_chunks else ""
+        )
+        entries["P99_tokens_per_chunk"] = (
+            tokens_per_chunk.percentile(0.99) if has_chunks else ""
+        )
 
     pretty_name = lambda s: " ".join([w.capitalize() for w in s.split("_")])
-    entries = {pretty_name(k): v for k, v in entries.items()}
+    return {pretty_name(k): v for k, v in entries.items()}
+
+
+@events.quitting.add_listener
+def _(environment, **kw):
+    if isinstance(environment.runner, WorkerRunner):
+        # the summary is produced by the master from the merged metrics
+        return
+    total_latency = CustomMetrics.get("total_latency")
+    if _main_num_failures(environment) > 0 or total_latency.count == 0:
+        print("Test failed due to failed requests")
+        environment.process_exit_code = 1
+        return
+
+    entries = build_summary(environment)
 
     # print in the final event handler to make sure our output is the last one
     @events.quit.add_listener
@@ -1205,3 +3427,95 @@ def _(environment, **kw):
             if f.tell() == 0:
                 writer.writeheader()
             writer.writerow(entries)
+
+
+class ControlServer:
+    """Local HTTP endpoint for changing the load of a running test.
+
+    GET /stats returns the summary of the metrics since the last reset,
+    POST /control takes a JSON object with any of `qps`, `users` (with an
+    optional `spawn_rate`) and `reset_stats`. The changes are applied together
+    and the stats reset last, so the new window starts with the new load: with
+    `users` the reset waits until the ramp to the new count completes. POST
+    /stop ends the test like -t does.
+    """
+
+    def __init__(self, environment, port):
+        self.environment = environment
+        self.server = gevent.pywsgi.WSGIServer(
+            ("127.0.0.1", port), self.handle, log=None
+        )
+        self.server.start()
+        print(f"Control server listening on http://127.0.0.1:{port}")
+
+    def handle(self, env, start_response):
+        method = env["REQUEST_METHOD"]
+        path = env["PATH_INFO"]
+        try:
+            if method == "GET" and path == "/stats":
+                status, data = "200 OK", self.stats()
+            elif method == "POST" and path == "/control":
+                length = int(env.get("CONTENT_LENGTH") or 0)
+                request = json.loads(env["wsgi.input"].read(length) or b"{}")
+                if not isinstance(request, dict):
+                    raise ValueError("the body must be a JSON object")
+                status, data = "200 OK", self.control(request)
+            elif method == "POST" and path == "/stop":
+                gevent.spawn(self.environment.runner.quit)
+                status, data = "200 OK", {"stopping": True}
+            else:
+                status, data = "404 Not Found", {"error": f"{method} {path} not found"}
+        except (ValueError, TypeError, KeyError) as e:
+            # e.g. {"qps": null}
+            status, data = "400 Bad Request", {"error": str(e)}
+        body = orjson.dumps(data)
+        start_response(
+            status,
+            [("Content-Type", "application/json"), ("Content-Length", str(len(body)))],
+        )
+        return [body]
+
+    def state(self):
+        return {
+            "qps": self.environment.parsed_options.qps,
+            "users": self.environment.runner.user_count,
+        }
+
+    def stats(self):
+        return {
+            **self.state(),
+            "num_failures": _main_num_failures(self.environment),
+            "summary": build_summary(self.environment),
+        }
+
+    def control(self, request):
+        options = self.environment.parsed_options
+        if "qps" in request:
+            if options.qps is None:
+                raise ValueError("the test wasn't started with --qps")
+            qps = float(request["qps"])
+            if qps <= 0:
+                raise ValueError("qps must be positive")
+        if "users" in request:
+            users = int(request["users"])
+            spawn_rate = float(request.get("spawn_rate") or options.spawn_rate)
+
+        if "qps" in request:
+            InitTracker.set_qps(qps)
+        if "users" in request:
+            if request.get("reset_stats"):
+                # runner.start() returns while the users are still spawning,
+                # reset on spawning_complete like at the start of the test
+                InitTracker.stats_reset_done = False
+            self.environment.runner.start(users, spawn_rate)
+        elif request.get("reset_stats"):
+            InitTracker.reset_stats()
+        return self.state()
+
+
+@events.init.add_listener
+def _start_control_server(environment, **_kwargs):
+    if isinstance(environment.runner, WorkerRunner):
+        return
+    if environment.parsed_options.control_port:
+        ControlServer(environment, environment.parsed_options.control_port)
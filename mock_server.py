@@ -0,0 +1,366 @@
+"""
+Mock OpenAI/vLLM/TGI server for benchmarking the load test client itself.
+
+Only listens on 127.0.0.1. Every completion generates exactly `max_tokens`
+tokens (like vLLM with ignore_eos) after --ttft ms, one token every --itl ms.
+Usage:
+
+    python mock_server.py --port 8000 --ttft 50 --itl 10
+
+Endpoints: /v1/models, /v1/completions, /v1/chat/completions, /v1/embeddings,
+/ (Together), /generate and /generate_stream (TGI) and /metrics with the vLLM
+gauges and counters the sweep scripts poll.
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import random
+
+HOST = "127.0.0.1"
+TOKEN_TEXT = "tok "
+EMBEDDING_SIZE = 16
+# distinct prompt prefixes remembered for the prefix cache counters
+MAX_SEEN_PREFIXES = 100000
+
+
+class ServerState:
+    """Counters behind /metrics, per server process."""
+
+    def __init__(self, max_running):
+        self.running = 0
+        self.waiting = 0
+        self.max_running = max_running
+        self.slots = asyncio.Semaphore(max_running) if max_running else None
+        self.success = 0
+        self.failures = 0
+        self.preemptions = 0
+        self.prefix_queries = 0
+        self.prefix_hits = 0
+        self.generation_tokens = 0
+        self.prompt_tokens = 0
+        self.seen_prefixes = set()
+
+
+class MockServer:
+    def __init__(self, options):
+        self.options = options
+        self.state = ServerState(options.max_running)
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    return
+                lines = head.decode("latin-1").split("\r\n")
+                method, path, _version = lines[0].split(" ", 2)
+                headers = {}
+                for line in lines[1:]:
+                    if ":" in line:
+                        key, value = line.split(":", 1)
+                        headers[key.strip().lower()] = value.strip()
+                body = b""
+                if "content-length" in headers:
+                    body = await reader.readexactly(int(headers["content-length"]))
+                await self.dispatch(method, path.split("?", 1)[0], body, writer)
+                if headers.get("connection", "").lower() == "close":
+                    return
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def dispatch(self, method, path, body, writer):
+        if method == "GET" and path == "/v1/models":
+            data = {
+                "object": "list",
+                "data": [{"id": self.options.model, "object": "model", "owned_by": "vllm"}],
+            }
+            await self.send_json(writer, 200, data)
+        elif method == "GET" and path == "/metrics":
+            await self.send(writer, 200, "text/plain; version=0.0.4", self.render_metrics())
+        elif method == "POST" and path in (
+            "/v1/completions",
+            "/v1/chat/completions",
+            "/v1/embeddings",
+            "/",
+            "/generate",
+            "/generate_stream",
+        ):
+            try:
+                request = json.loads(body)
+            except ValueError:
+                await self.send_json(writer, 400, {"error": "invalid JSON"})
+                return
+            if random.random() < self.options.failure_rate:
+                self.state.failures += 1
+                await self.send_json(writer, 500, {"error": "injected failure"})
+                return
+            await self.generate(path, request, writer)
+        else:
+            await self.send_json(writer, 404, {"error": f"{method} {path} not found"})
+
+    async def send(self, writer, status, content_type, data):
+        writer.write(
+            b"HTTP/1.1 %d %s\r\nContent-Type: %s\r\nContent-Length: %d\r\n\r\n"
+            % (status, b"OK" if status == 200 else b"Error", content_type.encode(), len(data))
+            + data
+        )
+        await writer.drain()
+
+    async def send_json(self, writer, status, data):
+        await self.send(writer, status, "application/json", json.dumps(data).encode())
+
+    def count_prompt(self, request):
+        # a rough token count and prefix reuse, only for the /metrics counters
+        prompt = json.dumps(
+            request.get("messages")
+            or request.get("prompt")
+            or request.get("inputs")
+            or request.get("input")
+            or ""
+        )
+        tokens = max(1, len(prompt) // 4)
+        self.state.prompt_tokens += tokens
+        self.state.prefix_queries += tokens
+        prefix = prompt[:256]
+        if prefix in self.state.seen_prefixes:
+            self.state.prefix_hits += min(tokens, 64)
+        else:
+            if len(self.state.seen_prefixes) >= MAX_SEEN_PREFIXES:
+                self.state.seen_prefixes.clear()
+            self.state.seen_prefixes.add(prefix)
+
+    async def generate(self, path, request, writer):
+        state = self.state
+        self.count_prompt(request)
+        if state.slots is not None:
+            state.waiting += 1
+            await state.slots.acquire()
+            state.waiting -= 1
+        state.running += 1
+        try:
+            if path == "/v1/embeddings":
+                await asyncio.sleep(self.options.ttft / 1000)
+                await self.send_json(writer, 200, self.embeddings_response())
+            elif path in ("/generate", "/generate_stream"):
+                await self.generate_tgi(path == "/generate_stream", request, writer)
+            else:
+                await self.generate_openai(path, request, writer)
+            state.success += 1
+        finally:
+            state.running -= 1
+            if state.slots is not None:
+                state.slots.release()
+
+    def embeddings_response(self):
+        return {
+            "object": "list",
+            "data": [{"object": "embedding", "index": 0, "embedding": [0.1] * EMBEDDING_SIZE}],
+            "model": self.options.model,
+            "usage": {"prompt_tokens": 1, "total_tokens": 1},
+        }
+
+    async def stream_tokens(self, writer, num_tokens, token_chunk, last_chunk, trailer):
+        """Writes a chunked SSE response with a chunk per token, `last_chunk` for the last one."""
+        writer.write(
+            b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+            b"Transfer-Encoding: chunked\r\n\r\n"
+        )
+        await asyncio.sleep(self.options.ttft / 1000)
+        itl = self.options.itl / 1000
+        for i in range(num_tokens):
+            if i > 0 and itl > 0:
+                await asyncio.sleep(itl)
+            self.write_chunk(writer, last_chunk if i == num_tokens - 1 else token_chunk)
+            await writer.drain()
+        self.write_chunk(writer, trailer)
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+        self.state.generation_tokens += num_tokens
+
+    @staticmethod
+    def write_chunk(writer, data):
+        if data:
+            writer.write(b"%x\r\n%s\r\n" % (len(data), data))
+
+    @staticmethod
+    def sse(data):
+        return b"data: " + json.dumps(data).encode() + b"\n\n"
+
+    async def generate_openai(self, path, request, writer):
+        chat = path == "/v1/chat/completions"
+        together = path == "/"
+        stream = request.get("stream_tokens" if together else "stream", False)
+        num_tokens = max(1, int(request.get("max_tokens") or 16))
+        logprobs = request.get("logprobs") is not None
+        usage = {
+            "prompt_tokens": 1,
+            "completion_tokens": num_tokens,
+            "total_tokens": num_tokens + 1,
+        }
+
+        if not stream:
+            await asyncio.sleep((self.options.ttft + self.options.itl * (num_tokens - 1)) / 1000)
+            text = TOKEN_TEXT * num_tokens
+            choice = {"index": 0, "finish_reason": "length"}
+            if chat:
+                choice["message"] = {"role": "assistant", "content": text}
+            else:
+                choice["text"] = text
+            if logprobs:
+                choice["logprobs"] = {"tokens": [TOKEN_TEXT] * num_tokens}
+            data = {"id": "mock", "model": self.options.model, "choices": [choice], "usage": usage}
+            self.state.generation_tokens += num_tokens
+            await self.send_json(writer, 200, {"output": data} if together else data)
+            return
+
+        def chunk(finish_reason=None):
+            choice = {"index": 0, "finish_reason": finish_reason}
+            if chat:
+                choice["delta"] = {"content": TOKEN_TEXT}
+            else:
+                choice["text"] = TOKEN_TEXT
+            if logprobs:
+                choice["logprobs"] = {"tokens": [TOKEN_TEXT]}
+            return self.sse({"id": "mock", "model": self.options.model, "choices": [choice]})
+
+        trailer = b""
+        if (request.get("stream_options") or {}).get("include_usage"):
+            trailer += self.sse(
+                {"id": "mock", "model": self.options.model, "choices": [], "usage": usage}
+            )
+        trailer += b"data: [DONE]\n\n"
+        await self.stream_tokens(writer, num_tokens, chunk(), chunk("length"), trailer)
+
+    async def generate_tgi(self, stream, request, writer):
+        num_tokens = max(1, int((request.get("parameters") or {}).get("max_new_tokens") or 16))
+        if not stream:
+            await asyncio.sleep((self.options.ttft + self.options.itl * (num_tokens - 1)) / 1000)
+            self.state.generation_tokens += num_tokens
+            await self.send_json(
+                writer,
+                200,
+                {
+                    "generated_text": TOKEN_TEXT * num_tokens,
+                    "details": {
+                        "finish_reason": "length",
+                        "generated_tokens": num_tokens,
+                        "tokens": [{"text": TOKEN_TEXT}] * num_tokens,
+                    },
+                },
+            )
+            return
+        token_chunk = self.sse({"token": {"id": 1, "text": TOKEN_TEXT, "special": False}})
+        await self.stream_tokens(writer, num_tokens, token_chunk, token_chunk, b"")
+
+    def render_metrics(self):
+        state = self.state
+        labels = f'{{model_name="{self.options.model}"}}'
+        kv_usage = state.running / state.max_running if state.max_running else 0.0
+        lines = [
+            "# HELP vllm:num_requests_running Number of requests in model execution batches.",
+            "# TYPE vllm:num_requests_running gauge",
+            f"vllm:num_requests_running{labels} {float(state.running)}",
+            "# HELP vllm:num_requests_waiting Number of requests waiting to be processed.",
+            "# TYPE vllm:num_requests_waiting gauge",
+            f"vllm:num_requests_waiting{labels} {float(state.waiting)}",
+            "# HELP vllm:kv_cache_usage_perc KV-cache usage. 1 means 100 percent usage.",
+            "# TYPE vllm:kv_cache_usage_perc gauge",
+            f"vllm:kv_cache_usage_perc{labels} {kv_usage}",
+            "# HELP vllm:num_preemptions_total Cumulative number of preemption from the engine.",
+            "# TYPE vllm:num_preemptions_total counter",
+            f"vllm:num_preemptions_total{labels} {float(state.preemptions)}",
+            "# HELP vllm:prefix_cache_queries_total Prefix cache queries, in terms of number of queried tokens.",
+            "# TYPE vllm:prefix_cache_queries_total counter",
+            f"vllm:prefix_cache_queries_total{labels} {float(state.prefix_queries)}",
+            "# HELP vllm:prefix_cache_hits_total Prefix cache hits, in terms of number of cached tokens.",
+            "# TYPE vllm:prefix_cache_hits_total counter",
+            f"vllm:prefix_cache_hits_total{labels} {float(state.prefix_hits)}",
+            "# HELP vllm:prompt_tokens_total Number of prefill tokens processed.",
+            "# TYPE vllm:prompt_tokens_total counter",
+            f"vllm:prompt_tokens_total{labels} {float(state.prompt_tokens)}",
+            "# HELP vllm:generation_tokens_total Number of generation tokens processed.",
+            "# TYPE vllm:generation_tokens_total counter",
+            f"vllm:generation_tokens_total{labels} {float(state.generation_tokens)}",
+            "# HELP vllm:request_success_total Count of successfully processed requests.",
+            "# TYPE vllm:request_success_total counter",
+            f'vllm:request_success_total{{finished_reason="length",model_name="{self.options.model}"}} {float(state.success)}',
+        ]
+        return ("\n".join(lines) + "\n").encode()
+
+
+async def serve(options):
+    server = MockServer(options)
+    srv = await asyncio.start_server(
+        server.handle_connection,
+        HOST,
+        options.port,
+        reuse_port=options.workers > 1,
+        backlog=4096,
+    )
+    async with srv:
+        await srv.serve_forever()
+
+
+def run_worker(options):
+    try:
+        asyncio.run(serve(options))
+    except KeyboardInterrupt:
+        pass
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--model", default="mock-model", help="Model name reported by /v1/models")
+    parser.add_argument("--ttft", type=float, default=0.0, help="Time to first token in ms")
+    parser.add_argument("--itl", type=float, default=0.0, help="Delay between tokens in ms")
+    parser.add_argument(
+        "--failure-rate",
+        type=float,
+        default=0.0,
+        help="Fraction of generation requests answered with HTTP 500",
+    )
+    parser.add_argument(
+        "--max-running",
+        type=int,
+        default=0,
+        help="Requests processed at once, the rest wait in a queue (shows up as num_requests_waiting). 0 means no limit",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Server processes sharing the port, so that the mock server isn't the bottleneck. /metrics only reports the process that answers it",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    print(
+        f"Mock server on http://{HOST}:{options.port} with {options.workers} worker(s), "
+        f"ttft {options.ttft} ms, itl {options.itl} ms, failure rate {options.failure_rate}"
+    )
+    if options.workers == 1:
+        run_worker(options)
+        return
+    processes = [
+        multiprocessing.Process(target=run_worker, args=(options,), daemon=True)
+        for _ in range(options.workers)
+    ]
+    for p in processes:
+        p.start()
+    try:
+        for p in processes:
+            p.join()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+"""
+Decides when a load test step has reached steady state.
+
+Keeps a sliding window of samples of several signals (requests running and
+waiting on the server, KV-cache usage, completion rate) and calls it a
+plateau once every signal in the window is flat: its trend over the window is
+small or statistically insignificant, and its noise is bounded. Usage:
+
+    detector = PlateauDetector(window_seconds=30, min_seconds=30, max_seconds=600)
+    while True:
+        detector.observe_snapshot(scraper.scrape())
+        done, reason = detector.check()
+        if done:
+            break
+        time.sleep(1)
+"""
+
+import math
+import time
+from collections import deque
+
+# below these values a signal counts as idle, so e.g. an empty waiting queue
+# with an occasional request in it isn't taken for a noisy signal
+DEFAULT_SCALES = {
+    "running": 1.0,
+    "waiting": 1.0,
+    "kv_cache_usage": 0.01,
+    "completion_rate": 0.1,
+}
+
+# request counts fluctuate like Poisson counts even at a steady arrival rate,
+# their standard deviation is allowed to reach this many times sqrt(mean)
+COUNT_SIGNALS = ("running", "waiting")
+COUNT_NOISE = 2.0
+
+# rates computed from the counts completed between two polls, dt apart: the
+# count is Poisson with mean rate*dt, so the rate's noise is sqrt(rate/dt)
+RATE_SIGNALS = ("completion_rate",)
+
+
+def _linear_fit(points):
+    """Least squares slope of (t, v) points and the standard error of the slope."""
+    n = len(points)
+    mean_t = sum(t for t, _ in points) / n
+    mean_v = sum(v for _, v in points) / n
+    stt = sum((t - mean_t) ** 2 for t, _ in points)
+    if stt == 0:
+        return 0.0, 0.0
+    slope = sum((t - mean_t) * (v - mean_v) for t, v in points) / stt
+    intercept = mean_v - slope * mean_t
+    residual = sum((v - intercept - slope * t) ** 2 for t, v in points)
+    stderr = math.sqrt(residual / (n - 2) / stt) if n > 2 else float("inf")
+    return slope, stderr
+
+
+class PlateauDetector:
+    """Sliding window plateau test over several signals.
+
+    A signal is flat when, over the last `window_seconds`:
+    - its linear trend changes it by at most `slope_tolerance` of its mean, or
+      the trend isn't significant (|slope| < `t_threshold` standard errors), and
+    - its coefficient of variation is at most `cv_tolerance`, or for the
+      request counts and rates, its standard deviation is within Poisson noise.
+    Means are floored at the signal's scale from DEFAULT_SCALES.
+
+    A plateau needs all signals to be flat and at least `min_seconds` since the
+    start, after `max_seconds` the step ends anyway. The start is the first
+    sample, or the first check() when no sample arrived yet, so the timeout
+    also fires when the server never answers.
+    """
+
+    def __init__(
+        self,
+        window_seconds=30.0,
+        min_seconds=30.0,
+        max_seconds=600.0,
+        slope_tolerance=0.05,
+        cv_tolerance=0.25,
+        t_threshold=2.0,
+        scales=None,
+    ):
+        self.window_seconds = window_seconds
+        self.min_seconds = max(min_seconds, window_seconds)
+        self.max_seconds = max_seconds
+        self.slope_tolerance = slope_tolerance
+        self.cv_tolerance = cv_tolerance
+        self.t_threshold = t_threshold
+        self.scales = dict(DEFAULT_SCALES, **(scales or {}))
+        self.start_time = None
+        self._samples = {}
+        self._last_counter = None
+
+    def add(self, t=None, **signals):
+        """Records the values of the signals at time `t`, None values are skipped."""
+        t = time.time() if t is None else t
+        if self.start_time is None:
+            self.start_time = t
+        for name, value in signals.items():
+            if value is None:
+                continue
+            samples = self._samples.setdefault(name, deque())
+            samples.append((t, float(value)))
+            while samples and samples[0][0] < t - self.window_seconds:
+                samples.popleft()
+
+    def observe_snapshot(self, snapshot):
+        """Records a prom_scraper.VllmSnapshot, the completion rate comes from the success counter."""
+        if snapshot is None:
+            return
+        completion_rate = None
+        if snapshot.request_success is not None:
+            if self._last_counter is not None:
+                last_t, last_value = self._last_counter
+                if snapshot.timestamp > last_t and snapshot.request_success >= last_value:
+                    completion_rate = (snapshot.request_success - last_value) / (
+                        snapshot.timestamp - last_t
+                    )
+            self._last_counter = (snapshot.timestamp, snapshot.request_success)
+        self.add(
+            snapshot.timestamp,
+            running=snapshot.running,
+            waiting=snapshot.waiting,
+            kv_cache_usage=snapshot.kv_cache_usage,
+            completion_rate=completion_rate,
+        )
+
+    def mean(self, name):
+        samples = self._samples.get(name)
+        if not samples:
+            return None
+        return sum(v for _, v in samples) / len(samples)
+
+    def signal_status(self, name):
+        """Returns (flat, description) of one signal over the current window."""
+        samples = list(self._samples.get(name, ()))
+        if len(samples) < 3 or samples[-1][0] - samples[0][0] < self.window_seconds * 0.8:
+            return False, f"{name}: not enough samples"
+        values = [v for _, v in samples]
+        mean = sum(values) / len(values)
+        scale = max(abs(mean), self.scales.get(name, 1.0))
+        std = math.sqrt(sum((v - mean) ** 2 for v in values) / (len(values) - 1))
+        slope, stderr = _linear_fit(samples)
+        change = abs(slope) * self.window_seconds / scale
+        significant = (stderr == 0 and slope != 0) or abs(slope) > self.t_threshold * stderr
+        cv = std / scale
+        noisy = cv > self.cv_tolerance
+        if noisy and name in COUNT_SIGNALS:
+            noisy = std > COUNT_NOISE * math.sqrt(scale)
+        elif noisy and name in RATE_SIGNALS:
+            interval = (samples[-1][0] - samples[0][0]) / (len(samples) - 1)
+            noisy = std > COUNT_NOISE * math.sqrt(scale / interval)
+        flat = (change <= self.slope_tolerance or not significant) and not noisy
+        return flat, f"{name}: mean {mean:.3g} change {change:.1%} cv {cv:.2f}"
+
+    def check(self, now=None):
+        """Returns (done, reason): done once all signals are flat, or at max_seconds."""
+        now = time.time() if now is None else now
+        if self.start_time is None:
+            self.start_time = now
+        elapsed = now - self.start_time
+        if not self._samples:
+            if elapsed >= self.max_seconds:
+                return True, f"timeout after {elapsed:.0f}s (no samples)"
+            return False, "no samples"
+        statuses = [self.signal_status(name) for name in self._samples]
+        description = ", ".join(text for _, text in statuses)
+        if elapsed >= self.max_seconds:
+            return True, f"timeout after {elapsed:.0f}s ({description})"
+        if elapsed < self.min_seconds:
+            return False, f"{elapsed:.0f}s < min {self.min_seconds:.0f}s ({description})"
+        if statuses and all(flat for flat, _ in statuses):
+            return True, f"plateau after {elapsed:.0f}s ({description})"
+        return False, description
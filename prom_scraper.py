@@ -0,0 +1,205 @@
+"""
+Scrapes the server's Prometheus /metrics page over a persistent connection.
+
+The page is parsed while it's being read, and only the lines of the wanted
+series are parsed at all (label values and all). Usage:
+
+    scraper = PromScraper("http://127.0.0.1:8000")
+    snapshot = scraper.scrape()
+    print(snapshot.running, snapshot.waiting, snapshot.kv_cache_usage)
+"""
+
+import http.client
+import time
+import urllib.parse
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+READ_SIZE = 64 * 1024
+
+# field of VllmSnapshot -> metric names, newer vLLM names first
+VLLM_SERIES = {
+    "running": ["vllm:num_requests_running"],
+    "waiting": ["vllm:num_requests_waiting"],
+    "kv_cache_usage": ["vllm:kv_cache_usage_perc", "vllm:gpu_cache_usage_perc"],
+    "preemptions": ["vllm:num_preemptions_total", "vllm:num_preemptions"],
+    "prefix_cache_hits": ["vllm:prefix_cache_hits_total", "vllm:gpu_prefix_cache_hits_total"],
+    "prefix_cache_queries": [
+        "vllm:prefix_cache_queries_total",
+        "vllm:gpu_prefix_cache_queries_total",
+    ],
+    "request_success": ["vllm:request_success_total"],
+}
+
+# fields that are a per-engine fraction, averaged over the label sets instead of
+# summed (two engines at 60% KV cache usage are at 60%, not 120%)
+MEAN_FIELDS = {"kv_cache_usage"}
+
+
+@dataclass
+class Sample:
+    name: str
+    labels: Dict[str, str]
+    value: float
+
+
+@dataclass
+class VllmSnapshot:
+    """The vLLM series the sweep scripts use, summed over label sets (models, engines).
+
+    The MEAN_FIELDS are averaged over the label sets instead. A field is None when the server doesn't export any of its metric names.
+    """
+
+    timestamp: float
+    running: Optional[float] = None
+    waiting: Optional[float] = None
+    kv_cache_usage: Optional[float] = None
+    preemptions: Optional[float] = None
+    prefix_cache_hits: Optional[float] = None
+    prefix_cache_queries: Optional[float] = None
+    request_success: Optional[float] = None
+    samples: List[Sample] = field(default_factory=list, repr=False)
+
+
+def _parse_labels(text):
+    labels = {}
+    i = 0
+    n = len(text)
+    while i < n:
+        eq = text.index("=", i)
+        key = text[i:eq].strip().lstrip(",").strip()
+        # the value is a quoted string with \\, \" and \n escapes
+        j = eq + 2
+        value = []
+        while text[j] != '"':
+            if text[j] == "\\":
+                j += 1
+                value.append("\n" if text[j] == "n" else text[j])
+            else:
+                value.append(text[j])
+            j += 1
+        labels[key] = "".join(value)
+        i = j + 1
+        while i < n and text[i] in ", ":
+            i += 1
+    return labels
+
+
+def parse_line(line, wanted=None):
+    """Parses one sample line of the text format, None for comments and unwanted series."""
+    if not line or line[0] == "#":
+        return None
+    brace = line.find("{")
+    space = line.find(" ")
+    if brace != -1 and (space == -1 or brace < space):
+        name = line[:brace]
+        if wanted is not None and name not in wanted:
+            return None
+        end = line.rindex("}")
+        labels = _parse_labels(line[brace + 1 : end])
+        rest = line[end + 1 :].split()
+    else:
+        name = line[:space]
+        if wanted is not None and name not in wanted:
+            return None
+        labels = {}
+        rest = line[space + 1 :].split()
+    # the optional timestamp after the value is ignored
+    return Sample(name, labels, float(rest[0]))
+
+
+class PromScraper:
+    """Fetches /metrics over one keep-alive HTTP connection, reconnecting when it breaks."""
+
+    def __init__(self, host, path="/metrics", timeout=5.0, series=None):
+        url = urllib.parse.urlsplit(host if "://" in host else "http://" + host)
+        self._netloc = url.netloc
+        self._https = url.scheme == "https"
+        self.path = path
+        self.timeout = timeout
+        self.series = dict(VLLM_SERIES if series is None else series)
+        self._wanted_bytes = {
+            name.encode() for names in self.series.values() for name in names
+        }
+        self._conn = None
+
+    def _connect(self):
+        cls = http.client.HTTPSConnection if self._https else http.client.HTTPConnection
+        self._conn = cls(self._netloc, timeout=self.timeout)
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _iter_lines(self):
+        for attempt in range(2):
+            if self._conn is None:
+                self._connect()
+            try:
+                self._conn.request("GET", self.path, headers={"Accept": "text/plain"})
+                response = self._conn.getresponse()
+                break
+            except (http.client.HTTPException, OSError):
+                # the server may have closed the idle connection, retry once
+                self.close()
+                if attempt == 1:
+                    raise
+        if response.status != 200:
+            response.read()
+            raise RuntimeError(f"{self.path} returned HTTP {response.status}")
+        tail = b""
+        while True:
+            data = response.read1(READ_SIZE)
+            if not data:
+                break
+            lines = (tail + data).split(b"\n")
+            tail = lines.pop()
+            for line in lines:
+                yield line
+        if tail:
+            yield tail
+
+    def scrape_samples(self):
+        """Returns the samples of the wanted series."""
+        samples = []
+        try:
+            for line in self._iter_lines():
+                # cheap check of the name on the bytes before decoding and parsing
+                if not line or line[:1] == b"#":
+                    continue
+                if line.partition(b"{")[0].partition(b" ")[0] not in self._wanted_bytes:
+                    continue
+                sample = parse_line(line.decode("utf-8").rstrip("\r"))
+                if sample is not None:
+                    samples.append(sample)
+        except Exception:
+            self.close()
+            raise
+        return samples
+
+    def scrape(self):
+        """Returns a VllmSnapshot (or the fields of `series`) from a single request."""
+        samples = self.scrape_samples()
+        totals = {}
+        counts = {}
+        for sample in samples:
+            totals[sample.name] = totals.get(sample.name, 0.0) + sample.value
+            counts[sample.name] = counts.get(sample.name, 0) + 1
+        snapshot = VllmSnapshot(timestamp=time.time(), samples=samples)
+        for key, names in self.series.items():
+            for name in names:
+                if name in totals:
+                    value = totals[name]
+                    if key in MEAN_FIELDS:
+                        value /= counts[name]
+                    setattr(snapshot, key, value)
+                    break
+        return snapshot
+
+    def try_scrape(self):
+        """Like scrape(), but returns None instead of raising when the server can't be reached."""
+        try:
+            return self.scrape()
+        except (RuntimeError, ValueError, http.client.HTTPException, OSError):
+            return None